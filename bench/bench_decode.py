@@ -0,0 +1,134 @@
+#!./venv/bin/python3
+"""
+Compare loading JPEGs for display with a full decode against decoding
+at a reduced scale (JPEG draft mode) before the final resample.
+
+Give some sample JPEGs, or a set of synthetic photos is generated. Each
+method runs in its own process, so that the peak memory (max RSS) can
+be compared. The difference between the images the two methods produce
+is also reported.
+
+  ./bench/bench_decode.py --window 1920x1080 ~/Pictures/*.jpg
+
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), "..", "src"))
+
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageStat
+
+from photohop.imaging import load_image, rotate_to_exif
+
+
+def load_image_full(path, size, rotation=0):
+    """ How images were loaded before draft mode was used """
+    image = Image.open(path)
+    image = rotate_to_exif(image)
+    if rotation > 0:
+        image = image.rotate(rotation, expand=True)
+    w, h = size
+    if image.size[0] > w or image.size[1] > h:
+        image.thumbnail((w - 2, h - 2), Image.LANCZOS)
+    else:
+        image.load()
+    return image
+
+
+def load_image_draft(path, size, rotation=0):
+    return load_image(path, size, rotation).image
+
+
+METHODS = {"full": load_image_full, "draft": load_image_draft}
+
+
+def make_samples(dir_path):
+    """
+    Synthetic photos at some typical camera resolutions, with some detail in
+    them. Some are marked as rotated in their EXIF data, like portrait photos
+    from most cameras
+
+    """
+    paths = []
+    sizes = [(6000, 4000, 1), (5472, 3648, 6), (4032, 3024, 1), (4032, 3024, 8), (4000, 6000, 1), (2048, 1536, 1)]
+    for i, (w, h, orientation) in enumerate(sizes):
+        image = Image.radial_gradient("L").resize((w, h)).convert("RGB")
+        draw = ImageDraw.Draw(image)
+        for j in range(0, w, 37):
+            draw.line([(j, 0), (w - j, h)], fill=(j % 255, 80, 160), width=3)
+        image = Image.blend(image, Image.effect_noise((w, h), 40).convert("RGB"), 0.3)
+        image = image.filter(ImageFilter.SMOOTH)
+        path = os.path.join(dir_path, "sample{}.jpg".format(i))
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        image.save(path, quality=92, exif=exif)
+        paths.append(path)
+    return paths
+
+
+def run_method(method, paths, size, repeats):
+    """ Run in a child process: print the time taken and max RSS """
+    load = METHODS[method]
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for path in paths:
+            load(path, size)
+    elapsed = time.perf_counter() - start
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(elapsed / (repeats * len(paths)), max_rss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="JPEG files to load")
+    parser.add_argument("--window", default="1920x1080", help="window size to fit images to")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--run", choices=list(METHODS), help=argparse.SUPPRESS)
+    parser.add_argument("--make-samples", help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+    size = tuple(int(x) for x in opts.window.split("x"))
+
+    if opts.run:
+        run_method(opts.run, opts.paths, size, opts.repeats)
+        return
+    if opts.make_samples:
+        print("\n".join(make_samples(opts.make_samples)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = opts.paths
+        if not paths:
+            # Make them in another process: a child's max RSS starts from
+            # that of its parent
+            paths = subprocess.check_output(
+                [sys.executable, __file__, "--make-samples", tmp_dir]
+            ).decode().split()
+        print("{} images, window {}x{}".format(len(paths), *size))
+        for method in METHODS:
+            output = subprocess.check_output(
+                [sys.executable, __file__, "--run", method, "--window", opts.window,
+                 "--repeats", str(opts.repeats)] + paths
+            )
+            per_image, max_rss = output.split()
+            print("{:6s} {:8.1f} ms/image   max RSS {:6.1f} MB".format(
+                method, float(per_image) * 1000, int(max_rss) / 1024
+            ))
+
+        # How different do the results look?
+        for path in paths:
+            full = load_image_full(path, size)
+            draft = load_image_draft(path, size)
+            if full.size != draft.size:
+                print("{}: sizes differ: {} {}".format(path, full.size, draft.size))
+                continue
+            diff = ImageStat.Stat(ImageChops.difference(full, draft)).mean
+            print("{}: mean pixel difference {:.2f}".format(os.path.basename(path), sum(diff) / len(diff)))
+
+
+if __name__ == "__main__":
+    main()
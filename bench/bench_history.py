@@ -0,0 +1,67 @@
+#!./venv/bin/python3
+"""
+Measure the cost of adding an entry to the viewing history, writing each
+line straight to the file, as ViewingHistory used to, against buffering
+them with HistoryWriter.
+
+The file is written in a temporary dir, or in --dir, which should be
+somewhere like a network home dir to see the difference that matters.
+
+  ./bench/bench_history.py --entries 2000 --dir ~/
+
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), "..", "src"))
+
+from photohop.history import HistoryWriter
+
+
+def write_unbuffered(path, lines):
+    """ How history used to be written """
+    for line in lines:
+        with open(path, "a") as f:
+            f.write(line)
+
+
+def write_buffered(path, lines, fsync=False):
+    writer = HistoryWriter(path, fsync=fsync)
+    for line in lines:
+        writer.write(line)
+    writer.close()
+
+
+def time_per_entry(fn, dir, lines, **kwargs):
+    fd, path = tempfile.mkstemp(dir=dir, suffix=".txt")
+    os.close(fd)
+    try:
+        start = time.perf_counter()
+        fn(path, lines, **kwargs)
+        return (time.perf_counter() - start) / len(lines)
+    finally:
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=5000, help="number of history entries to write")
+    parser.add_argument("--dir", help="dir to write the history file in")
+    opts = parser.parse_args()
+
+    lines = ["2019/2019-06 Holiday/IMG_{:05d}.jpg\n".format(i) for i in range(opts.entries)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dir = opts.dir or tmp_dir
+        for name, fn, kwargs in [
+            ("open per entry", write_unbuffered, {}),
+            ("buffered", write_buffered, {}),
+            ("buffered, fsync", write_buffered, {"fsync": True}),
+        ]:
+            print("{:<20} {:8.2f} us/entry".format(name, time_per_entry(fn, dir, lines, **kwargs) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!./venv/bin/python3
+"""
+Measure the time and memory taken to load a stored collection index and
+pick the first photo from it, for a large synthetic collection, comparing
+the memory-mapped index with the pickled arrays it replaced.
+
+The mapped index is also loaded with refresh=True, as the slideshow does
+in the background once it's started: once with nothing changed on disk,
+and once after a photo has been added to one dir, which means writing
+the index again. The dirs are really made, empty, but the photos in them
+are only in the index, as a refresh doesn't look at files in dirs that
+haven't changed.
+
+Unlike a plain load, a refresh costs time and memory in proportion to
+the number of dirs, whatever has changed: every dir's name is decoded
+(for the lookup of dirs by name and the list of each dir's subdirs) and
+every dir is stat'ed, which on a network share is a round trip each. So
+the refresh times here are for a local disk, and are a lower bound.
+
+Each load is done in a fresh process, so that its max RSS can be measured.
+
+  ./bench/bench_index_load.py --dirs 10000 --files 100
+
+"""
+import argparse
+import os
+import pickle
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), "..", "src"))
+
+from photohop.index import CollectionIndex, INDEX_ARRAYS, _IndexBuilder
+from photohop.selector import PhotoSelector
+
+
+def synthetic_index(num_dirs, files_per_dir, root_dir, path):
+    """ An index of a collection whose dirs have been made under root_dir """
+    builder = _IndexBuilder()
+    builder.add_dir(".", -1, os.stat(root_dir).st_mtime, [], [])
+    for i in range(num_dirs):
+        rel_dir = "event{:05d}".format(i)
+        filenames = ["IMG_{:05d}.JPG".format(j) for j in range(files_per_dir)]
+        builder.add_dir(rel_dir, 0, os.stat(os.path.join(root_dir, rel_dir)).st_mtime, filenames,
+                        [1.5e9 + i + j for j in range(files_per_dir)])
+    return CollectionIndex(root_dir, [], arrays=builder.arrays(), path=path)
+
+
+def load_pickled(path, root_dir):
+    """ How the index used to be loaded """
+    with open(path, "rb") as f:
+        data = pickle.load(f)
+    return CollectionIndex(root_dir, [], arrays=data["arrays"])
+
+
+def make_indexes(num_dirs, files_per_dir, dir):
+    root_dir = os.path.join(dir, "photos")
+    for i in range(num_dirs):
+        os.makedirs(os.path.join(root_dir, "event{:05d}".format(i)))
+    index = synthetic_index(num_dirs, files_per_dir, root_dir, os.path.join(dir, "index.index"))
+    # Pickled first, as saving swaps the arrays for views of the saved file
+    with open(os.path.join(dir, "index.pickle"), "wb") as f:
+        pickle.dump({"arrays": dict((name, getattr(index, name)) for (name, _) in INDEX_ARRAYS)}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    index.save()
+    print("{} photos in {} dirs".format(index.num_photos, index.num_dirs))
+
+
+def run(kind, path, root_dir):
+    start = time.perf_counter()
+    if kind == "pickle":
+        index = load_pickled(path, root_dir)
+    elif kind == "mmap":
+        index = CollectionIndex.load_from_path(path, root_dir, [])
+    else:
+        index = CollectionIndex.load(root_dir, [], path=path, refresh=True)
+    selector = PhotoSelector(root_dir, [], index=index)
+    photo = selector.get_photo()
+    elapsed = time.perf_counter() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("{:16s} {:8.1f} ms to first photo, {:6.1f} MB max RSS, {} arrays  ({})".format(
+        kind, elapsed * 1000, maxrss, type(index.file_mtimes).__name__, photo.rel_path
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dirs", type=int, default=10000, help="number of photo dirs")
+    parser.add_argument("--files", type=int, default=100, help="number of photos in each dir")
+    parser.add_argument("--make", metavar="DIR", help=argparse.SUPPRESS)
+    parser.add_argument("--run", nargs=3, metavar=("KIND", "PATH", "ROOT"), help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.run:
+        run(*opts.run)
+        return
+    if opts.make:
+        make_indexes(opts.dirs, opts.files, opts.make)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Made in another process too, since max RSS carries over to child
+        # processes
+        subprocess.run([
+            sys.executable, __file__, "--dirs", str(opts.dirs), "--files", str(opts.files), "--make", tmp_dir
+        ], check=True)
+        root_dir = os.path.join(tmp_dir, "photos")
+        for kind, path in [("pickle", os.path.join(tmp_dir, "index.pickle")),
+                           ("mmap", os.path.join(tmp_dir, "index.index")),
+                           ("refresh", os.path.join(tmp_dir, "index.index")),
+                           ("refresh-changed", os.path.join(tmp_dir, "index.index"))]:
+            if kind == "refresh-changed":
+                # A new photo in one dir
+                open(os.path.join(root_dir, "event00000", "new.jpg"), "wb").close()
+            # Read it once first, so they all come from the OS's file cache
+            with open(path, "rb") as f:
+                while f.read(1 << 20):
+                    pass
+            subprocess.run([sys.executable, __file__, "--run", kind, path, root_dir], check=True)
+
+
+if __name__ == "__main__":
+    main()
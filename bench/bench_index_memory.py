@@ -0,0 +1,89 @@
+#!./venv/bin/python3
+"""
+Measure the memory taken by the collection index and selector for a
+large synthetic collection, comparing the packed array representation
+with the dicts of lists of strings used before.
+
+The collection is generated in memory, so nothing is written to disk.
+
+  ./bench/bench_index_memory.py --dirs 10000 --files 100
+
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict, namedtuple
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), "..", "src"))
+
+from photohop.index import CollectionIndex, _IndexBuilder
+from photohop.selector import PhotoSelector
+
+DirRecord = namedtuple("DirRecord", ["mtime", "subdirs", "filenames", "file_mtimes"])
+
+
+def synthetic_dirs(num_dirs, files_per_dir):
+    """ Generates (rel_dir, parent id, mtime, filenames, file mtimes), like a scan would """
+    yield ".", -1, 1.5e9, [], []
+    for year in range(30):
+        yield str(1990 + year), 0, 1.5e9, [], []
+    for i in range(num_dirs):
+        filenames = ["IMG_{:05d}.JPG".format(j) for j in range(files_per_dir)]
+        yield os.path.join(str(1990 + i % 30), "event{:05d}".format(i)), 1 + i % 30, \
+            1.5e9 + i, filenames, [1.5e9 + i + j for j in range(files_per_dir)]
+
+
+def build_old(num_dirs, files_per_dir):
+    """ The index dict and the selector structures built from it before """
+    dirs = OrderedDict()
+    for rel_dir, _, mtime, filenames, file_mtimes in synthetic_dirs(num_dirs, files_per_dir):
+        dirs[rel_dir] = DirRecord(mtime, [], filenames, file_mtimes)
+    photo_dirs = []
+    photo_dir_images = {}
+    for rel_dir, record in dirs.items():
+        if len(record.filenames):
+            photo_dirs.append(rel_dir)
+            photo_dir_images[rel_dir] = list(record.filenames)
+    return dirs, photo_dirs, photo_dir_images
+
+
+def build_packed(num_dirs, files_per_dir):
+    builder = _IndexBuilder()
+    for rel_dir, parent, mtime, filenames, file_mtimes in synthetic_dirs(num_dirs, files_per_dir):
+        builder.add_dir(rel_dir, parent, mtime, filenames, file_mtimes)
+    index = CollectionIndex("/photos", [], arrays=builder.arrays())
+    return index, PhotoSelector("/photos", [], index=index)
+
+
+def measure(fn, *args):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed, current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dirs", type=int, default=10000, help="number of photo dirs")
+    parser.add_argument("--files", type=int, default=100, help="number of photos in each dir")
+    opts = parser.parse_args()
+
+    print("{} photos in {} dirs".format(opts.dirs * opts.files, opts.dirs))
+    for name, fn in [("dicts of lists", build_old), ("packed arrays", build_packed)]:
+        elapsed, current, peak = measure(fn, opts.dirs, opts.files)
+        print("{:15s} {:8.1f} MB held, {:8.1f} MB peak  ({:.1f}s to build)".format(
+            name, current / 1e6, peak / 1e6, elapsed
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!./venv/bin/python3
+"""
+Time the stages of rendering photos for display, without a UI: opening
+the file and reading its metadata, decoding (at a reduced scale, for
+JPEGs), resizing, and turning it to its EXIF orientation, as well as the
+whole of Renderer.render().
+
+Give some photos, or a corpus of synthetic JPEGs and PNGs of various
+sizes is generated, some marked as rotated. Each photo is rendered
+repeats times and the mean, median and 95th percentile are reported for
+each stage, in ms. The total is for rendering from scratch, with no
+cache; "cached" is for a photo that's already in the in-memory cache.
+
+  ./bench/bench_render.py --window 1920x1080 ~/Pictures/*.jpg
+
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), "..", "src"))
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from photohop.imaging import fit_size, orientation_transpose, read_metadata
+from photohop.render import Renderer
+from photohop.selector import SelectedPhoto
+
+STAGES = ["open", "decode", "resize", "orient", "total", "cached"]
+
+
+def make_corpus(dir_path):
+    """
+    Synthetic photos: JPEGs at typical camera and phone resolutions, some
+    marked as rotated in their EXIF data, and PNGs, like screenshots
+
+    """
+    paths = []
+    sizes = [
+        (6000, 4000, 1, "jpg"), (5472, 3648, 6, "jpg"), (4032, 3024, 8, "jpg"), (4000, 6000, 1, "jpg"),
+        (2048, 1536, 3, "jpg"), (1024, 768, 1, "jpg"), (2560, 1440, 1, "png"), (800, 600, 1, "png"),
+    ]
+    for i, (w, h, orientation, ext) in enumerate(sizes):
+        image = Image.radial_gradient("L").resize((w, h)).convert("RGB")
+        draw = ImageDraw.Draw(image)
+        for j in range(0, w, 37):
+            draw.line([(j, 0), (w - j, h)], fill=(j % 255, 80, 160), width=3)
+        image = Image.blend(image, Image.effect_noise((w, h), 40).convert("RGB"), 0.3)
+        image = image.filter(ImageFilter.SMOOTH)
+        path = os.path.join(dir_path, "sample{}.{}".format(i, ext))
+        if ext == "jpg":
+            exif = Image.Exif()
+            exif[0x0112] = orientation
+            image.save(path, quality=92, exif=exif)
+        else:
+            image.save(path)
+        paths.append(path)
+    return paths
+
+
+def time_stages(path, size):
+    """
+    Time each stage of loading an image separately, doing what
+    imaging.load_image does, one step at a time
+
+    """
+    times = {}
+    start = time.perf_counter()
+    image = Image.open(path)
+    metadata = read_metadata(image)
+    times["open"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    transpose = orientation_transpose(metadata.orientation)
+    swap_axes = transpose in (Image.ROTATE_90, Image.ROTATE_270, Image.TRANSPOSE, Image.TRANSVERSE)
+    full_size = image.size[::-1] if swap_axes else image.size
+    target = fit_size(full_size, size)
+    if image.format == "JPEG" and target != full_size:
+        image.draft(None, target[::-1] if swap_axes else target)
+    image.load()
+    times["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if target != full_size:
+        image.thumbnail(target[::-1] if swap_axes else target, Image.LANCZOS)
+    times["resize"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if transpose is not None:
+        image = image.transpose(transpose)
+    times["orient"] = time.perf_counter() - start
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="photos to render")
+    parser.add_argument("--window", default="1920x1080", help="window size to fit photos to")
+    parser.add_argument("--repeats", type=int, default=5)
+    opts = parser.parse_args()
+    size = tuple(int(x) for x in opts.window.split("x"))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = opts.paths or make_corpus(tmp_dir)
+        print("{} photos, window {}x{}, {} repeats".format(len(paths), *size, opts.repeats))
+        # Nothing cached, and no previews, so every render starts from the file
+        cold = Renderer(cache_bytes=0, prefetch_workers=1)
+        warm = Renderer(prefetch_workers=1)
+        times = dict((stage, []) for stage in STAGES)
+        for path in paths:
+            for _ in range(opts.repeats):
+                for stage, seconds in time_stages(path, size).items():
+                    times[stage].append(seconds)
+
+                photo = SelectedPhoto(os.path.dirname(path), os.path.basename(path), "")
+                start = time.perf_counter()
+                cold.render(photo, size)
+                times["total"].append(time.perf_counter() - start)
+
+                warm.render(SelectedPhoto(os.path.dirname(path), os.path.basename(path), ""), size)
+                start = time.perf_counter()
+                warm.render(photo, size)
+                times["cached"].append(time.perf_counter() - start)
+        cold.shutdown()
+        warm.shutdown()
+
+    print("{:8s} {:>9s} {:>9s} {:>9s}".format("stage", "mean", "p50", "p95"))
+    for stage in STAGES:
+        samples = sorted(times[stage])
+        print("{:8s} {:9.2f} {:9.2f} {:9.2f}".format(
+            stage, statistics.mean(samples) * 1000, statistics.median(samples) * 1000,
+            samples[min(int(len(samples) * 0.95), len(samples) - 1)] * 1000
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!./venv/bin/python3
+"""
+Compare the parallel scandir-based collection scan against the plain
+os.walk that PhotoSelector used to do.
+
+Builds a synthetic collection in a temporary dir and times both. On a
+local disk there's little latency for the threads to hide, so use
+--latency to add a delay to every scandir/stat call, roughly simulating
+a network share.
+
+  ./bench/bench_scan.py --dirs 2000 --files 100 --latency 1
+
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), "..", "src"))
+
+from photohop.index import CollectionIndex, image_filenames
+
+
+def walk_scan(root_dir, exclude):
+    """ The scan PhotoSelector used to do at every launch """
+    exclude_paths = [os.path.join(root_dir, x) for x in exclude]
+    photo_dir_images = {}
+    for dirname, dirs, filenames in os.walk(root_dir):
+        if dirname in exclude_paths:
+            dirs.clear()
+            continue
+        image_fns = image_filenames(filenames)
+        if len(image_fns):
+            rel_dir = os.path.relpath(dirname, root_dir)
+            photo_dir_images[rel_dir] = image_fns
+    return photo_dir_images
+
+
+def walk_stat_scan(root_dir, exclude):
+    """
+    The same walk, but also getting the mtimes the index stores, for a
+    like-for-like comparison
+
+    """
+    photo_dir_images = walk_scan(root_dir, exclude)
+    for rel_dir, image_fns in photo_dir_images.items():
+        os.stat(os.path.join(root_dir, rel_dir))
+        for fn in image_fns:
+            os.stat(os.path.join(root_dir, rel_dir, fn))
+    return photo_dir_images
+
+
+def index_scan(root_dir, exclude, workers):
+    index = CollectionIndex(root_dir, exclude)
+    index.refresh(workers=workers)
+    return dict(index.photo_dirs())
+
+
+def make_tree(root_dir, num_dirs, files_per_dir):
+    for i in range(num_dirs):
+        dir_path = os.path.join(root_dir, str(1990 + i % 30), "event{:05d}".format(i))
+        os.makedirs(dir_path)
+        for j in range(files_per_dir):
+            ext = "JPG" if j % 5 else "png"
+            open(os.path.join(dir_path, "IMG_{:05d}.{}".format(j, ext)), "w").close()
+        open(os.path.join(dir_path, "Thumbs.db"), "w").close()
+    os.makedirs(os.path.join(root_dir, "music", "album"))
+    open(os.path.join(root_dir, "music", "album", "cover.jpg"), "w").close()
+
+
+def add_latency(seconds):
+    """ Slow down the calls that go to the filesystem """
+    def delayed(fn):
+        def _delayed(*args, **kwargs):
+            time.sleep(seconds)
+            return fn(*args, **kwargs)
+        return _delayed
+    os.scandir = delayed(os.scandir)
+    os.stat = delayed(os.stat)
+    # DirEntry.stat() can't be patched, so stat the path instead
+    import photohop.index
+    _list_dir = photohop.index.list_dir
+
+    def list_dir(abs_dir, mtime):
+        record = _list_dir(abs_dir, mtime)
+        for fn in record.filenames:
+            time.sleep(seconds)
+        return record
+    photohop.index.list_dir = list_dir
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dirs", type=int, default=2000, help="number of photo dirs to create")
+    parser.add_argument("--files", type=int, default=100, help="number of files in each dir")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16], help="thread pool sizes to try")
+    parser.add_argument("--latency", type=float, default=0., help="ms delay added to each filesystem call")
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        print("Creating {} dirs of {} files".format(opts.dirs, opts.files))
+        make_tree(root_dir, opts.dirs, opts.files)
+        if opts.latency:
+            add_latency(opts.latency / 1000.)
+        exclude = ["music"]
+
+        walk_time, expected = timed(walk_scan, root_dir, exclude)
+        print("os.walk:             {:8.3f}s".format(walk_time))
+        walk_time, expected = timed(walk_stat_scan, root_dir, exclude)
+        print("os.walk + mtimes:    {:8.3f}s".format(walk_time))
+        for workers in opts.workers:
+            scan_time, result = timed(index_scan, root_dir, exclude, workers)
+            same = list(result.items()) == list(expected.items())
+            print("scandir, {:2d} workers: {:8.3f}s  {}".format(
+                workers, scan_time, "same result" if same else "RESULT DIFFERS"
+            ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+#!./venv/bin/python3
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), "src"))
+
+from photohop.pregenerate import main
+
+if __name__ == "__main__":
+    main()
@@ -6,4 +6,5 @@ sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), "src"))
 
 from photohop.slideshow import random_slideshow
 
-random_slideshow()
+if __name__ == "__main__":
+    random_slideshow()
@@ -0,0 +1,76 @@
+"""
+Timing for showing slides automatically, at a fixed interval.
+
+Slides are due at fixed deadlines, start + n * interval, rather than an
+interval after the last one appeared, so that the time taken to load
+each one doesn't add up. Switching to a slide is started early by
+however long that's been taking, so it appears on time, and slides that
+appear late anyway are counted and reported.
+
+"""
+import logging
+import math
+import time
+
+debug = logging.debug
+
+
+class AdvanceSchedule(object):
+    """
+    Deadlines for an auto-advancing slideshow. Call advanced() every time a
+    slide has been shown, with how long it took to show.
+
+    A slide more than tolerance seconds after its deadline counts as
+    missed. If the slideshow falls more than a whole interval behind, the
+    deadlines it's missed are skipped, rather than rushing through slides
+    to catch up.
+
+    """
+    def __init__(self, interval, tolerance=0.1, clock=time.monotonic):
+        self.interval = interval
+        self.tolerance = tolerance
+        self.clock = clock
+        self.deadline = clock() + interval
+        self.shown = 0
+        self.missed = 0
+        self.total_lateness = 0.
+        # Moving average of the time taken to show a slide
+        self.show_time = 0.
+
+    def restart(self):
+        """ Start counting again from now, after a slide's been changed by hand """
+        self.deadline = self.clock() + self.interval
+
+    def time_to_start(self):
+        """ Seconds until the next slide should start being shown, to be ready by its deadline """
+        return self.deadline - self.show_time - self.clock()
+
+    def advanced(self, show_time):
+        """
+        A slide has just appeared, having taken show_time seconds to show.
+        Returns how late it was, in seconds (negative if it was early).
+
+        """
+        now = self.clock()
+        lateness = now - self.deadline
+        self.shown += 1
+        if lateness > self.tolerance:
+            self.missed += 1
+            self.total_lateness += lateness
+            logging.warning("slide {:.0f} ms late (missed {} of {})".format(
+                lateness * 1000, self.missed, self.shown
+            ))
+        self.show_time = show_time if self.shown == 1 else 0.8 * self.show_time + 0.2 * show_time
+        if self.show_time > self.interval:
+            debug("slides take %.1fs to show, longer than the interval of %.1fs", self.show_time, self.interval)
+        # The next deadline, skipping any that have already gone by
+        self.deadline += self.interval * max(1, math.ceil(lateness / self.interval))
+        return lateness
+
+    def stats(self):
+        return {
+            "shown": self.shown,
+            "missed": self.missed,
+            "mean_lateness": self.total_lateness / self.missed if self.missed else 0.,
+            "show_time": self.show_time,
+        }
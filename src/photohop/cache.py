@@ -0,0 +1,94 @@
+"""
+In-memory cache of images that have been loaded for display.
+
+"""
+import threading
+from collections import OrderedDict
+
+
+class ImageCache(object):
+    """
+    Least-recently-used cache of LoadedImages, limited by the number of
+    bytes their pixels take up, rather than the number of images.
+
+    Keys are (path, mtime, size, rotation), so that an image is reloaded
+    if the file changes. All the entries for a file can be found with
+    variants(), so that an image loaded at one size or rotation can be
+    reused for another.
+
+    Counts of hits, misses and evictions are kept for tuning the size of
+    the cache. It's safe to use from several threads.
+
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (loaded image, bytes)
+        self._entries = OrderedDict()
+        # (path, mtime) -> keys of its entries
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        """ Returns None if the key's not in the cache """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, loaded):
+        nbytes = image_bytes(loaded.image)
+        if nbytes > self.max_bytes:
+            # Would push everything else out
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (loaded, nbytes)
+            self._variants.setdefault(key[:2], set()).add(key)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def variants(self, path, mtime):
+        """ List (key, loaded image) for every entry for this file """
+        with self._lock:
+            return [(key, self._entries[key][0]) for key in self._variants.get((path, mtime), [])]
+
+    def _remove(self, key):
+        loaded, nbytes = self._entries.pop(key)
+        self.current_bytes -= nbytes
+        variants = self._variants[key[:2]]
+        variants.discard(key)
+        if not variants:
+            del self._variants[key[:2]]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+            }
+
+
+def image_bytes(image):
+    """ Approximate memory taken by the pixels of a PIL image """
+    if image is None:
+        return 0
+    band_bytes = 4 if image.mode in ("I", "F") else 1
+    return image.size[0] * image.size[1] * len(image.getbands()) * band_bytes
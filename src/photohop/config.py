@@ -2,13 +2,58 @@ import copy
 import json
 import os
 
-from appdirs import user_config_dir
+from appdirs import user_config_dir, user_cache_dir
 
 from photohop import __version__
 
 CONFIG_DEFAULTS = {
     "file_manager_cmd": "nemo {image}",
     "history_path": os.path.join(os.getcwd(), "viewing_history.txt"),
+    # History is written in batches: this is the longest an entry waits to
+    # be written. Set history_fsync to sync every write to disk
+    "history_flush_seconds": 5.,
+    "history_fsync": False,
+    # How to choose random photos: "dirs", "photos", "year" or "month"
+    "selection_strategy": "dirs",
+    # Move on to the next photo every this many seconds. 0 to start
+    # paused (p plays and pauses)
+    "auto_advance_seconds": 0,
+    # How likely photos in the viewing history are to be shown again,
+    # relative to those not seen before: 1 to ignore the history, 0 to
+    # never show them again
+    "seen_weight": 1.,
+    # Number of upcoming images to load in the background, and the number
+    # of threads to load them on
+    "prefetch_count": 3,
+    "prefetch_workers": 2,
+    # Memory to use for keeping loaded images, in bytes
+    "image_cache_bytes": 256 * 1024 * 1024,
+    # Disk space to use for downscaled copies of photos, which are much
+    # quicker to show again than the originals. 0 turns them off
+    "preview_cache_bytes": 2 * 1024 * 1024 * 1024,
+    # Where to keep them: None for the user's cache dir. May be shared
+    # between machines, even if they mount the collection in different places
+    "preview_dir": None,
+    # Watch the collection for photos being added or removed while the
+    # slideshow runs: "auto" uses inotify if it can, "poll" checks every
+    # watch_poll_seconds (needed for changes made on other machines to a
+    # network share) and "off" doesn't watch
+    "watch_collection": "auto",
+    "watch_poll_seconds": 300,
+    # Read the dates and orientations of all photos into a database in the
+    # background, and the number of processes to read them with
+    "read_metadata": True,
+    "metadata_workers": 2,
+    # Time the steps of showing each photo, printing a summary on exit (or
+    # when t is pressed), and write every timing to telemetry_trace_path,
+    # one JSON object per line, if it's set
+    "telemetry": False,
+    "telemetry_trace_path": None,
+    # Record a cProfile profile and tracemalloc snapshots (every
+    # profile_snapshot_seconds) of each session in a subdir of this dir.
+    # The PHOTOHOP_PROFILE environment variable sets it too
+    "profile_dir": None,
+    "profile_snapshot_seconds": 60.,
 }
 
 
@@ -56,3 +101,8 @@ class Config(object):
             self.config_dict[key] = CONFIG_DEFAULTS[key]
         else:
             raise KeyError("unknown config key '{}'".format(key))
+
+
+def cache_dir():
+    """ Directory for data we can regenerate, like the collection index """
+    return user_cache_dir(appname="photohop", appauthor="markgw", version=__version__)
@@ -0,0 +1,280 @@
+"""
+Record of the photos viewed, in a text file that sessions append to.
+
+Beside the history file is an index, giving the name of every session
+and where it starts in the file, so that opening the history doesn't
+mean reading it all: a session's entries are only read when they're
+asked for.
+
+"""
+import atexit
+import logging
+import os
+import threading
+from collections.abc import Mapping
+
+from photohop.telemetry import telemetry
+
+debug = logging.debug
+
+# Write buffered history entries once there are this many
+HISTORY_BATCH_SIZE = 50
+
+SESSION_PREFIX = "SESSION: "
+ENCODING = "utf-8"
+
+
+class ViewingHistory(object):
+    """
+    Path may be set to None, meaning no output is written.
+
+    Entries are buffered and written in batches by a HistoryWriter. Call
+    close() (or flush()) to make sure they've all been written.
+
+    sessions maps session names to lists of entries, in the order the
+    sessions were started. Sessions from earlier runs are read from the
+    file when they're first looked up.
+
+    """
+    def __init__(self, path, flush_interval=5., fsync=False):
+        self.path = path
+        # Byte offset in the file of each session's header line, in order.
+        # Sessions that haven't been written yet have None
+        self._offsets = {}
+        # Entries of the sessions that have been read, or started here
+        self._entries = {}
+        self.sessions = Sessions(self)
+        if path is not None:
+            self.index_path = path + ".index"
+            # If the file exists, load the index of previous viewing history
+            if os.path.exists(path):
+                self.load_history()
+            self.writer = HistoryWriter(path, flush_interval=flush_interval, fsync=fsync, on_write=self._written)
+        else:
+            self.writer = None
+
+    def _append_line(self, line):
+        if self.writer is not None:
+            self.writer.write(line)
+
+    def new_session(self, name):
+        if self.writer is not None:
+            # Finish off the last session before starting another
+            self.writer.flush()
+        # A new session replaces an old one with the same name
+        self._offsets.pop(name, None)
+        self._offsets[name] = None
+        self._entries[name] = []
+        self._append_line("{}{}\n".format(SESSION_PREFIX, name))
+
+    def add_entry(self, filename):
+        with telemetry.span("add_entry"):
+            self.current_session.append(filename)
+            self._append_line("{}\n".format(filename))
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def load_history(self):
+        """
+        Load the index of the sessions in the history file. The index is
+        rebuilt if it's missing or doesn't match the file, and brought up
+        to date if sessions were added to the file without it.
+
+        """
+        offsets = self._read_index()
+        if offsets and not self._session_starts_at(*offsets[-1]):
+            debug("history index doesn't match %s: rebuilding", self.path)
+            offsets = []
+        if offsets:
+            # Pick up any sessions written after the last one in the index
+            new_offsets = self._scan(offsets[-1][0])[1:]
+            if new_offsets:
+                self._append_index(new_offsets)
+            offsets.extend(new_offsets)
+        else:
+            offsets = self._scan(0)
+            self._write_index(offsets)
+        for offset, name in offsets:
+            self._offsets.pop(name, None)
+            self._offsets[name] = offset
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, "r", encoding=ENCODING, errors="surrogateescape") as f:
+                return [(int(offset), name) for (offset, _, name) in (line.rstrip("\n").partition(" ") for line in f)]
+        except (OSError, ValueError):
+            return []
+
+    def _session_starts_at(self, offset, name):
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return _decode(f.readline()) == "{}{}\n".format(SESSION_PREFIX, name)
+
+    def _scan(self, start):
+        """ Find the (offset, name) of every session header in the file from start on """
+        offsets = []
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if line.startswith(SESSION_PREFIX.encode(ENCODING)):
+                    offsets.append((offset, _decode(line)[len(SESSION_PREFIX):].rstrip("\n")))
+                offset += len(line)
+        return offsets
+
+    def _write_index(self, offsets):
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding=ENCODING, errors="surrogateescape") as f:
+                f.writelines("{} {}\n".format(offset, name) for (offset, name) in offsets)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logging.warning("could not write history index %s: %s", self.index_path, e)
+
+    def _append_index(self, offsets):
+        try:
+            with open(self.index_path, "a", encoding=ENCODING, errors="surrogateescape") as f:
+                f.writelines("{} {}\n".format(offset, name) for (offset, name) in offsets)
+        except OSError as e:
+            logging.warning("could not write history index %s: %s", self.index_path, e)
+
+    def _written(self, offset, lines):
+        """ Called by the writer with lines it's just written at offset, to index the sessions """
+        sessions = []
+        for line in lines:
+            if line.startswith(SESSION_PREFIX):
+                name = line[len(SESSION_PREFIX):].rstrip("\n")
+                sessions.append((offset, name))
+                if name in self._offsets:
+                    self._offsets[name] = offset
+            offset += len(line.encode(ENCODING, "surrogateescape"))
+        if sessions:
+            self._append_index(sessions)
+
+    def session_entries(self, name):
+        """ The entries of a session, read from the file if they've not been already """
+        entries = self._entries.get(name)
+        if entries is None:
+            offset = self._offsets[name]
+            entries = []
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                f.readline()
+                for line in f:
+                    line = _decode(line).rstrip("\n")
+                    if line.startswith(SESSION_PREFIX):
+                        break
+                    elif len(line.strip()):
+                        entries.append(line)
+            self._entries[name] = entries
+        return entries
+
+    @property
+    def session_names(self):
+        return list(self._offsets)
+
+    @property
+    def current_session(self):
+        return self.session_entries(next(reversed(self._offsets)))
+
+
+class Sessions(Mapping):
+    """ Read-only view of a ViewingHistory's sessions, which reads each session when it's needed """
+    def __init__(self, history):
+        self.history = history
+
+    def __getitem__(self, name):
+        if name not in self.history._offsets:
+            raise KeyError(name)
+        return self.history.session_entries(name)
+
+    def __iter__(self):
+        return iter(self.history.session_names)
+
+    def __len__(self):
+        return len(self.history._offsets)
+
+
+def _decode(line):
+    return line.decode(ENCODING, "surrogateescape")
+
+
+class HistoryWriter(object):
+    """
+    Appends lines to a file in batches, rather than opening and closing
+    it for every line, which is slow when it's on a network drive.
+
+    Lines are written once batch_size have been buffered, or flush_interval
+    seconds after the first of them was buffered, whichever comes first,
+    and when the writer is closed, which happens at the latest when the
+    program exits. If fsync is True, every write is synced to disk.
+
+    Apart from explicit flushes, writes happen on a background thread.
+
+    on_write, if given, is called after every write with the byte offset
+    the lines were written at and the lines.
+
+    """
+    def __init__(self, path, batch_size=HISTORY_BATCH_SIZE, flush_interval=5., fsync=False, on_write=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.on_write = on_write
+        self._buffer = []
+        self._timer = None
+        self._lock = threading.Lock()
+        # Don't lose anything on a normal exit
+        atexit.register(self.close)
+
+    def write(self, line):
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) >= self.batch_size:
+                # Write now, but not on this thread, which may be the UI's
+                self._start_timer(0)
+            elif self._timer is None:
+                self._start_timer(self.flush_interval)
+
+    def _start_timer(self, interval):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(interval, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+        try:
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write("".join(self._buffer).encode(ENCODING, "surrogateescape"))
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except OSError as e:
+            # Keep the lines, to try again next time
+            logging.warning("could not write viewing history to %s: %s", self.path, e)
+            return
+        debug("wrote %d history entries", len(self._buffer))
+        lines, self._buffer = self._buffer, []
+        if self.on_write is not None:
+            self.on_write(offset, lines)
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.close)
@@ -0,0 +1,223 @@
+"""
+Loading images ready for display.
+
+Nothing here depends on the UI toolkit, so images can be loaded on
+worker threads, leaving the UI to do no more than hand them over to be
+drawn.
+
+"""
+import datetime
+import logging
+from collections import namedtuple
+
+from PIL import Image, ExifTags  # $ pip install pillow
+
+from photohop.telemetry import telemetry
+
+debug = logging.debug
+
+# An image ready to show, with the metadata read from its file. full_size
+# is the size of the image after rotation, but before it was shrunk to fit
+# the window
+LoadedImage = namedtuple("LoadedImage", ["image", "metadata", "full_size"])
+
+# What we need from an image's header. orientation is the EXIF orientation
+# tag, timestamp the date from the EXIF DateTime tag (either may be None)
+# and size the stored width and height, before orientation
+ImageMetadata = namedtuple("ImageMetadata", ["orientation", "timestamp", "size"])
+
+# Transposes that rotate anticlockwise by a multiple of 90 degrees
+ROTATE_TRANSPOSES = {
+    90: Image.ROTATE_90,
+    180: Image.ROTATE_180,
+    270: Image.ROTATE_270,
+}
+
+# Each EXIF orientation, as whether to mirror the image left to right and
+# how far to rotate it anticlockwise after that, to get it upright
+EXIF_ORIENTATIONS = {
+    1: (False, 0),
+    2: (True, 0),
+    3: (False, 180),
+    4: (True, 180),
+    5: (True, 90),
+    6: (False, 270),
+    7: (True, 270),
+    8: (False, 90),
+}
+
+# The single transpose that does each combination of mirroring and rotation
+TRANSPOSES = {
+    (False, 0): None,
+    (False, 90): Image.ROTATE_90,
+    (False, 180): Image.ROTATE_180,
+    (False, 270): Image.ROTATE_270,
+    (True, 0): Image.FLIP_LEFT_RIGHT,
+    (True, 90): Image.TRANSPOSE,
+    (True, 180): Image.FLIP_TOP_BOTTOM,
+    (True, 270): Image.TRANSVERSE,
+}
+
+
+def orientation_transpose(orientation, rotation=0):
+    """
+    The transpose (or None) that puts an image with this EXIF orientation
+    upright and then rotates it anticlockwise by rotation degrees
+    """
+    mirror, upright_rotation = EXIF_ORIENTATIONS.get(orientation, (False, 0))
+    return TRANSPOSES[mirror, (upright_rotation + rotation) % 360]
+
+
+def load_image(path, size, rotation=0, metadata=None):
+    """
+    Load an image, rotate it to match its EXIF orientation and then by
+    rotation degrees, and shrink it to fit inside size (the width and
+    height of the window), keeping its aspect ratio.
+
+    Returns a LoadedImage, with the image fully decoded, and its metadata.
+    The image is None if the size is too small to show anything. If the
+    metadata has already been read, pass it in to save reading it again.
+
+    """
+    with telemetry.span("open"):
+        image = Image.open(path)  # note: let OS manage file cache
+    if metadata is None:
+        with telemetry.span("exif"):
+            metadata = read_metadata(image)
+    # The orientation and rotation are done together, by one transpose,
+    # after the image has been shrunk, so it only moves the pixels shown
+    transpose = orientation_transpose(metadata.orientation, rotation)
+    # Work out the image's final size, after it's been rotated
+    swap_axes = transpose in (Image.ROTATE_90, Image.ROTATE_270, Image.TRANSPOSE, Image.TRANSVERSE)
+    full_size = image.size[::-1] if swap_axes else image.size
+
+    w, h = size
+    if image.format == "JPEG" and w >= 3 and h >= 3:
+        # If the image is going to be shrunk, have the JPEG decoder scale it
+        # down (by 1/2, 1/4 or 1/8) to the smallest size that's at least as
+        # big as the final image, which is much faster than decoding it in
+        # full. It then gets resampled to the exact size as before
+        target = fit_size(full_size, size)
+        if target != full_size:
+            image.draft(None, target[::-1] if swap_axes else target)
+
+    if full_size[0] > w or full_size[1] > h:
+        # note: ImageOps.fit() copies image
+        # preserve aspect ratio
+        if w < 3 or h < 3:  # too small
+            return LoadedImage(None, metadata, full_size)
+        # The image isn't turned yet, so fit it to the window turned the same way
+        box = (h - 2, w - 2) if swap_axes else (w - 2, h - 2)
+        # Decoding happens here too, as the image hasn't been loaded yet
+        with telemetry.span("thumbnail"):
+            image.thumbnail(box, Image.LANCZOS)
+        debug("resized: win %s >= img %s", (w, h), image.size)
+    else:
+        with telemetry.span("decode"):
+            image.load()
+    if transpose is not None:
+        with telemetry.span("orient"):
+            image = image.transpose(transpose)
+    return LoadedImage(image, metadata, full_size)
+
+
+def fit_size(full_size, size):
+    """
+    The size an image of full_size gets shown at in a window of size, or
+    None if the window's too small
+
+    """
+    (iw, ih), (w, h) = full_size, size
+    if iw <= w and ih <= h:
+        return full_size
+    if w < 3 or h < 3:
+        return None
+    scale = min((w - 2) / iw, (h - 2) / ih)
+    return max(round(iw * scale), 1), max(round(ih * scale), 1)
+
+
+def rescale_loaded(loaded, size, rotation):
+    """
+    Make an image that's already been loaded fit a different window size,
+    after rotating it a further rotation degrees, without going back to the
+    file. Returns None if that can't be done without losing quality, which
+    is when the new size needs more pixels than the loaded image has.
+
+    """
+    image = loaded.image
+    full_size = loaded.full_size
+    if image is None:
+        return None
+    if rotation:
+        image = image.transpose(ROTATE_TRANSPOSES[rotation])
+        if rotation != 180:
+            full_size = full_size[::-1]
+    target = fit_size(full_size, size)
+    if target is None:
+        return LoadedImage(None, loaded.metadata, full_size)
+    if target[0] > image.size[0] or target[1] > image.size[1]:
+        return None
+    if target != image.size:
+        image = image.resize(target, Image.LANCZOS)
+    return LoadedImage(image, loaded.metadata, full_size)
+
+
+def quick_rescale(loaded, size):
+    """
+    Cheaply resize a loaded image to fit a different window size, for
+    showing while the window's being resized. Unlike rescale_loaded, this
+    will enlarge the image if it has to, so the quality may be poor.
+    Returns None if the window's too small.
+
+    """
+    if loaded.image is None:
+        return None
+    target = fit_size(loaded.full_size, size)
+    if target is None:
+        return None
+    if target == loaded.image.size:
+        return loaded.image
+    return loaded.image.resize(target, Image.BILINEAR)
+
+
+for ORIENTATION_TAG in ExifTags.TAGS.keys():
+    if ExifTags.TAGS[ORIENTATION_TAG] == 'Orientation':
+        break
+DATETIME_TAG = 306
+
+
+def read_metadata(image):
+    """
+    Read an opened image's metadata, parsing its EXIF data just once.
+    Images without EXIF data, like most PNGs, just get None for the EXIF
+    fields.
+
+    """
+    try:
+        exif = image.getexif()
+    except Exception as e:
+        debug("could not read EXIF data: %s", e)
+        exif = {}
+    return ImageMetadata(exif.get(ORIENTATION_TAG), exif_timestamp(exif.get(DATETIME_TAG)), image.size)
+
+
+def rotate_to_exif(image, orientation=None):
+    if orientation is None:
+        orientation = read_metadata(image).orientation
+    transpose = orientation_transpose(orientation)
+    if transpose is not None:
+        image = image.transpose(transpose)
+    return image
+
+
+def exif_timestamp(timestamp_field):
+    """ Date from an EXIF date/time value, or None if it's missing or invalid """
+    if not isinstance(timestamp_field, str):
+        return None
+    if timestamp_field.startswith("0000"):
+        # Zero timestamp
+        return None
+    try:
+        return datetime.datetime.strptime(timestamp_field.partition(" ")[0], "%Y:%m:%d")
+    except ValueError:
+        return None
@@ -0,0 +1,546 @@
+"""
+Persistent index of the image files in a photo collection.
+
+Walking a big collection on a network share can take minutes, so the
+result is stored in the cache dir and reloaded on the next launch
+instead. Pass rebuild=True to CollectionIndex.load() to throw away the
+stored index and walk the whole collection again, or refresh=True to
+bring it up to date by only re-listing directories that have changed
+(which still means a stat of every directory).
+
+To keep memory use down on big collections, the index doesn't hold a
+Python string for every file. All the names are packed into a single
+bytes string table and everything else is in flat arrays, indexed by
+integer dir and file ids. Strings are only decoded for the entries that
+are actually used.
+
+The stored index is these arrays written out as they are in memory,
+after a short header, so loading it is just a matter of memory-mapping
+the file: nothing is read until it's used, and the time to start up
+doesn't depend on the size of the collection.
+
+"""
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import queue
+import struct
+import sys
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
+from photohop.config import cache_dir
+
+debug = logging.debug
+
+# Increase whenever the stored format changes, so old indexes get rebuilt
+INDEX_VERSION = 3
+
+# A stored index starts with this, then the length of a JSON header, as
+# a little-endian 64-bit int, then the header. The arrays follow, each
+# starting on an 8-byte boundary, at the offsets given in the header
+INDEX_MAGIC = b"PHOTOHOP"
+INDEX_PREFIX = struct.Struct("<8sQ")
+
+# Number of threads listing directories in parallel. On a network share,
+# most of the time goes on waiting for stats, so it pays to have several
+# requests in flight at once
+SCAN_WORKERS = 8
+
+IMAGE_EXTENSIONS = frozenset(["jpg", "png"])
+
+# The result of listing a single directory. subdirs are names relative to
+# the directory itself; filenames (image files only) are paired with their
+# mtimes in file_mtimes
+DirRecord = namedtuple("DirRecord", ["mtime", "subdirs", "filenames", "file_mtimes"])
+
+# Counts of directories affected by a refresh
+RefreshStats = namedtuple("RefreshStats", ["added", "removed", "changed"])
+
+# The arrays that make up an index. Dir d has its name (path relative to
+# root_dir) in dir_names[dir_name_offsets[d]:dir_name_offsets[d+1]] and
+# owns the files with ids from dir_file_starts[d] up to dir_file_starts[d+1].
+# File names are laid out in file_names in the same way. Unknown mtimes
+# are stored as NaN
+INDEX_ARRAYS = [
+    ("dir_names", None),
+    ("dir_name_offsets", "q"),
+    ("dir_mtimes", "d"),
+    ("dir_parents", "i"),
+    ("dir_file_starts", "q"),
+    ("file_names", None),
+    ("file_name_offsets", "q"),
+    ("file_mtimes", "d"),
+    ("file_dirs", "i"),
+]
+
+
+class CollectionIndex(object):
+    """
+    Listing of every directory under root_dir, with the image files in each.
+
+    Directories are included even when they contain no images, so that the
+    full tree structure is available. They're numbered in the order os.walk
+    visits them, so the root dir is always 0, and their names are paths
+    relative to root_dir ("." for the root itself). Files are numbered so
+    that each dir's files have consecutive ids.
+
+    """
+    def __init__(self, root_dir, exclude, arrays=None, path=None, token=None):
+        self.root_dir = root_dir
+        self.exclude = list(exclude)
+        if arrays is None:
+            arrays = _IndexBuilder().arrays()
+        self._set_arrays(arrays)
+        # Where the index is saved. None means it's never saved
+        self.path = path
+        # Identifies this set of ids: changes whenever the ids do, so that
+        # anything stored by file id can tell if it's out of date
+        self.token = token if token is not None else _new_token()
+        # After a refresh that changed the ids: the token before, and an
+        # array mapping each file id from before to its new id (-1 if the
+        # file's gone), so that things stored by file id can be carried over
+        self.renumbered = None
+
+    def _set_arrays(self, arrays):
+        for name, _ in INDEX_ARRAYS:
+            setattr(self, name, arrays[name])
+        # Lookups from names to ids, only built when needed
+        self._dir_ids = None
+        self._file_ids = {}
+
+    @staticmethod
+    def load(root_dir, exclude, path=None, rebuild=False, refresh=False):
+        """
+        Load the stored index for this collection, building it if there
+        isn't one yet, or if rebuild=True. With refresh=True, a stored
+        index is updated to reflect changes since it was saved, which means
+        a stat of every dir: see refresh(). If the refresh fails, the
+        stored index is used as it is.
+
+        """
+        if path is None:
+            path = default_index_path(root_dir)
+        index = None
+        if not rebuild:
+            index = CollectionIndex.load_from_path(path, root_dir, exclude)
+        if index is None:
+            debug("building index of %s", root_dir)
+            index = CollectionIndex.build(root_dir, exclude, path=path)
+            index.save()
+        elif refresh:
+            try:
+                stats = index.refresh()
+            except OSError as e:
+                logging.warning("could not refresh index of {}, using it as it was: {}".format(root_dir, e))
+                return index
+            logging.info("refreshed index of {}: {} dirs added, {} removed, {} changed".format(
+                root_dir, stats.added, stats.removed, stats.changed
+            ))
+            if stats != (0, 0, 0):
+                index.save()
+        return index
+
+    @staticmethod
+    def load_from_path(path, root_dir, exclude):
+        """
+        Returns None if there's no usable index at the path: it doesn't
+        exist, is from an old version, or was built with different options.
+
+        The file is memory-mapped, rather than read.
+
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            header, arrays = _map_index(path)
+        except Exception as e:
+            logging.warning("could not read index {}: {}".format(path, e))
+            return None
+        if header.get("version") != INDEX_VERSION or \
+                header.get("byteorder") != sys.byteorder or \
+                header.get("root_dir") != os.path.abspath(root_dir) or \
+                header.get("exclude") != sorted(exclude):
+            debug("stored index %s is out of date", path)
+            return None
+        return CollectionIndex(root_dir, exclude, arrays=arrays, path=path, token=header["token"])
+
+    @staticmethod
+    def build(root_dir, exclude, path=None):
+        """ Walk the whole collection to build a new index """
+        index = CollectionIndex(root_dir, exclude, path=path)
+        # Refreshing an empty index lists every directory
+        index.refresh()
+        return index
+
+    def refresh(self, workers=SCAN_WORKERS):
+        """
+        Bring the index up to date with the collection on disk.
+
+        Only directories whose mtime has changed since they were last listed
+        get listed again. Adding, removing or renaming an entry updates the
+        mtime of the directory containing it, but not of any further
+        ancestors, so every known directory still needs a stat, but unchanged
+        ones are never re-listed and their files are never stat'ed.
+
+        So unlike loading, refreshing takes time in proportion to the number
+        of dirs, even if nothing's changed: as well as the stat of each, all
+        the dir names are decoded, to look dirs up by name and find their
+        subdirs. On a network share with many dirs, that's too slow to wait
+        for at startup, which is why the slideshows do it in the background.
+
+        Note that a file modified in place does not change its directory's
+        mtime, so its stored mtime will be out of date until its directory
+        changes for some other reason.
+
+        Directories are checked in parallel by a pool of threads, but the
+        result is the same as a sequential walk, in the same order.
+
+        Returns a RefreshStats with the numbers of directories added,
+        removed and changed.
+
+        Raises OSError, leaving the index as it was, if root_dir can't be
+        read, or if every photo in the index seems to have gone, which is
+        much more likely to mean a share that isn't mounted than a
+        collection that's been emptied.
+
+        """
+        exclude = set(os.path.normpath(x) for x in self.exclude)
+        old_ids = self.dir_ids
+        old_subdirs = self._subdir_names()
+
+        def check_dir(rel_dir):
+            """
+            Returns the up-to-date record for the dir and whether it's new or
+            changed. Unchanged dirs are returned as their old dir id
+
+            """
+            abs_dir = os.path.join(self.root_dir, rel_dir)
+            try:
+                mtime = os.stat(abs_dir).st_mtime
+            except OSError:
+                # Dir has gone
+                return None, None
+            old_id = old_ids.get(rel_dir)
+            if old_id is not None and self.dir_mtimes[old_id] == mtime:
+                return old_id, None
+            try:
+                record = list_dir(abs_dir, mtime)
+            except OSError:
+                # Can't list it: skip, as os.walk does
+                return None, None
+            record = record._replace(subdirs=[
+                d for d in record.subdirs if _rel_join(rel_dir, d) not in exclude
+            ])
+            return record, ("added" if old_id is None else "changed")
+
+        def subdirs(record):
+            if isinstance(record, DirRecord):
+                return record.subdirs
+            return old_subdirs[record]
+
+        # Check every dir, submitting subdirs as soon as their parent is done
+        checked = {}
+        counts = {"added": 0, "changed": 0}
+        done = queue.Queue()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            def submit(rel_dir):
+                future = pool.submit(check_dir, rel_dir)
+                future.add_done_callback(lambda f: done.put((rel_dir, f)))
+
+            submit(".")
+            outstanding = 1
+            while outstanding:
+                rel_dir, future = done.get()
+                outstanding -= 1
+                record, status = future.result()
+                if record is None:
+                    continue
+                checked[rel_dir] = record
+                if status is not None:
+                    counts[status] += 1
+                for d in subdirs(record):
+                    submit(_rel_join(rel_dir, d))
+                    outstanding += 1
+
+        if "." not in checked:
+            raise OSError("can't read {}".format(self.root_dir))
+
+        removed = sum(1 for rel_dir in old_ids if rel_dir not in checked)
+        stats = RefreshStats(counts["added"], removed, counts["changed"])
+        if stats == (0, 0, 0):
+            # Keep the arrays as they are, which may be mapped from the file
+            return stats
+
+        # Pack the dirs in the order os.walk would visit them
+        builder = _IndexBuilder()
+        id_map = array("i", repeat(-1, self.num_photos))
+        stack = [(".", -1)]
+        while stack:
+            rel_dir, parent = stack.pop()
+            record = checked.get(rel_dir)
+            if record is None:
+                continue
+            start = len(builder.file_mtimes)
+            if isinstance(record, DirRecord):
+                dir_id = builder.add_dir(rel_dir, parent, record.mtime, record.filenames, record.file_mtimes)
+                old_id = old_ids.get(rel_dir)
+                if old_id is not None:
+                    # Files that are still there keep their place in the map
+                    new_ids = dict((filename, start + i) for (i, filename) in enumerate(record.filenames))
+                    for file_id in self.dir_files(old_id):
+                        id_map[file_id] = new_ids.get(self.file_name(file_id), -1)
+            else:
+                dir_id = builder.copy_dir(self, record, parent)
+                # Copied in the same order
+                for file_id in self.dir_files(record):
+                    id_map[file_id] = start + file_id - self.dir_file_starts[record]
+            stack.extend((_rel_join(rel_dir, d), dir_id) for d in reversed(subdirs(record)))
+        if self.num_photos and not len(builder.file_mtimes):
+            raise OSError("every photo under {} has gone: is it mounted?".format(self.root_dir))
+
+        self._set_arrays(builder.arrays())
+        self.renumbered = (self.token, id_map)
+        self.token = _new_token()
+        return stats
+
+    def save(self):
+        """
+        Write the index to its path. Afterwards, the arrays are views of the
+        saved file, rather than taking up memory of their own.
+
+        """
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        arrays = [(name, memoryview(getattr(self, name)).cast("B")) for (name, _) in INDEX_ARRAYS]
+        offsets = {}
+        offset = 0
+        for name, data in arrays:
+            offsets[name] = (offset, len(data))
+            offset = _align(offset + len(data))
+        header = json.dumps({
+            "version": INDEX_VERSION,
+            "byteorder": sys.byteorder,
+            "root_dir": os.path.abspath(self.root_dir),
+            "exclude": sorted(self.exclude),
+            "token": self.token,
+            "arrays": offsets,
+        }).encode("utf-8")
+        # Write to a temporary file and move it into place, so that we never
+        # leave a half-written index behind. That also leaves any index
+        # that's mapped from the old file as it was
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(INDEX_PREFIX.pack(INDEX_MAGIC, len(header)))
+            f.write(header)
+            f.write(bytes(_align(f.tell()) - f.tell()))
+            for name, data in arrays:
+                f.write(data)
+                f.write(bytes(_align(len(data)) - len(data)))
+        os.replace(tmp_path, self.path)
+        try:
+            self._set_arrays(_map_index(self.path)[1])
+        except Exception as e:
+            logging.warning("could not map saved index {}: {}".format(self.path, e))
+
+    @property
+    def num_dirs(self):
+        return len(self.dir_mtimes)
+
+    @property
+    def num_photos(self):
+        return len(self.file_mtimes)
+
+    def dir_name(self, dir_id):
+        return os.fsdecode(bytes(self.dir_names[self.dir_name_offsets[dir_id]:self.dir_name_offsets[dir_id + 1]]))
+
+    def dir_files(self, dir_id):
+        """ Range of the ids of the files in the dir """
+        return range(self.dir_file_starts[dir_id], self.dir_file_starts[dir_id + 1])
+
+    def file_name(self, file_id):
+        return os.fsdecode(bytes(
+            self.file_names[self.file_name_offsets[file_id]:self.file_name_offsets[file_id + 1]]
+        ))
+
+    def file_mtime(self, file_id):
+        mtime = self.file_mtimes[file_id]
+        return None if math.isnan(mtime) else mtime
+
+    @property
+    def dir_ids(self):
+        """ Mapping from relative dir paths to dir ids """
+        if self._dir_ids is None:
+            self._dir_ids = dict((self.dir_name(d), d) for d in range(self.num_dirs))
+        return self._dir_ids
+
+    def file_id(self, rel_dir, filename):
+        """ Look up the id of a file, returning None if it's not in the index """
+        dir_id = self.dir_ids.get(rel_dir)
+        if dir_id is None:
+            return None
+        file_ids = self._file_ids.get(dir_id)
+        if file_ids is None:
+            file_ids = dict((self.file_name(f), f) for f in self.dir_files(dir_id))
+            self._file_ids[dir_id] = file_ids
+        return file_ids.get(filename)
+
+    def photo_dirs(self):
+        """ Iterate over (rel_dir, image filenames) for dirs that contain images """
+        for dir_id in range(self.num_dirs):
+            file_ids = self.dir_files(dir_id)
+            if len(file_ids):
+                yield self.dir_name(dir_id), [self.file_name(f) for f in file_ids]
+
+    def _subdir_names(self):
+        """ For each dir id, the names of the dir's subdirs, in order """
+        subdirs = [[] for _ in range(self.num_dirs)]
+        for dir_id in range(1, self.num_dirs):
+            subdirs[self.dir_parents[dir_id]].append(os.path.basename(self.dir_name(dir_id)))
+        return subdirs
+
+
+class _IndexBuilder(object):
+    """ Accumulates dirs in order to pack them into a new set of index arrays """
+    def __init__(self):
+        self.dir_names = bytearray()
+        self.dir_name_offsets = array("q", [0])
+        self.dir_mtimes = array("d")
+        self.dir_parents = array("i")
+        self.dir_file_starts = array("q", [0])
+        self.file_names = bytearray()
+        self.file_name_offsets = array("q", [0])
+        self.file_mtimes = array("d")
+        self.file_dirs = array("i")
+
+    def _add_dir_entry(self, rel_dir, parent, mtime):
+        dir_id = len(self.dir_mtimes)
+        self.dir_names += os.fsencode(rel_dir)
+        self.dir_name_offsets.append(len(self.dir_names))
+        self.dir_mtimes.append(mtime)
+        self.dir_parents.append(parent)
+        return dir_id
+
+    def add_dir(self, rel_dir, parent, mtime, filenames, file_mtimes):
+        dir_id = self._add_dir_entry(rel_dir, parent, mtime)
+        for filename in filenames:
+            self.file_names += os.fsencode(filename)
+            self.file_name_offsets.append(len(self.file_names))
+        self.file_mtimes.extend(math.nan if m is None else m for m in file_mtimes)
+        self.file_dirs.extend(repeat(dir_id, len(filenames)))
+        self.dir_file_starts.append(len(self.file_mtimes))
+        return dir_id
+
+    def copy_dir(self, index, old_id, parent):
+        """ Add a dir from an existing index unchanged """
+        dir_id = self._add_dir_entry(index.dir_name(old_id), parent, index.dir_mtimes[old_id])
+        start, end = index.dir_file_starts[old_id], index.dir_file_starts[old_id + 1]
+        # The dir's filenames are contiguous, so can be copied in one go
+        names_start, names_end = index.file_name_offsets[start], index.file_name_offsets[end]
+        shift = len(self.file_names) - names_start
+        self.file_names += index.file_names[names_start:names_end]
+        self.file_name_offsets.extend(offset + shift for offset in index.file_name_offsets[start + 1:end + 1])
+        self.file_mtimes.extend(index.file_mtimes[start:end])
+        self.file_dirs.extend(repeat(dir_id, end - start))
+        self.dir_file_starts.append(len(self.file_mtimes))
+        return dir_id
+
+    def arrays(self):
+        arrays = dict((name, getattr(self, name)) for (name, _) in INDEX_ARRAYS)
+        arrays["dir_names"] = bytes(self.dir_names)
+        arrays["file_names"] = bytes(self.file_names)
+        return arrays
+
+
+def _map_index(path):
+    """
+    Memory-map a stored index, returning its header and a dict of its
+    arrays, each of which is a view of the mapped file
+
+    """
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, header_size = INDEX_PREFIX.unpack_from(data)
+    if magic != INDEX_MAGIC:
+        raise ValueError("not an index file")
+    header = json.loads(data[INDEX_PREFIX.size:INDEX_PREFIX.size + header_size].decode("utf-8"))
+    view = memoryview(data)
+    start = _align(INDEX_PREFIX.size + header_size)
+    arrays = {}
+    for name, typecode in INDEX_ARRAYS:
+        offset, size = header["arrays"][name]
+        arrays[name] = view[start + offset:start + offset + size].cast(typecode or "B")
+    return header, arrays
+
+
+def _align(offset):
+    """ Round up to a multiple of 8 """
+    return (offset + 7) & ~7
+
+
+def _new_token():
+    return os.urandom(8).hex()
+
+
+def collection_key(root_dir):
+    """ Name used for files in the cache dir that belong to the collection at root_dir """
+    return hashlib.sha1(os.path.abspath(root_dir).encode("utf-8")).hexdigest()[:16]
+
+
+def default_index_path(root_dir):
+    """ Each collection root gets its own index file in the cache dir """
+    return os.path.join(cache_dir(), "index", "{}.index".format(collection_key(root_dir)))
+
+
+def list_dir(abs_dir, mtime):
+    """
+    List a single directory, returning a DirRecord.
+
+    Follows the same rules as os.walk: symlinks to directories are neither
+    descended into nor treated as files.
+
+    """
+    subdirs = []
+    image_fns = []
+    file_mtimes = []
+    with os.scandir(abs_dir) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                try:
+                    is_symlink = entry.is_symlink()
+                except OSError:
+                    is_symlink = False
+                if not is_symlink:
+                    subdirs.append(entry.name)
+            elif is_image_filename(entry.name):
+                image_fns.append(entry.name)
+                try:
+                    file_mtimes.append(entry.stat().st_mtime)
+                except OSError:
+                    file_mtimes.append(None)
+    return DirRecord(mtime, subdirs, image_fns, file_mtimes)
+
+
+def _rel_join(rel_dir, name):
+    # Gives the same relative paths as os.path.relpath on a walked dir
+    if rel_dir == ".":
+        return name
+    return os.path.join(rel_dir, name)
+
+
+def is_image_filename(filename):
+    return filename.rpartition(".")[2].lower() in IMAGE_EXTENSIONS
+
+
+def image_filenames(filenames):
+    return [filename for filename in filenames if is_image_filename(filename)]
@@ -0,0 +1,286 @@
+"""
+Persistent store of the metadata of every photo in a collection.
+
+Capture dates, orientations and sizes are read from the headers of the
+files by a background job, using a pool of processes, and stored in an
+SQLite database in the cache dir. The job can be stopped at any time:
+next time it's run, it skips the photos it's already done.
+
+Once the store is filled, selecting photos by date and showing their
+info doesn't need the files to be opened at all.
+
+"""
+import datetime
+import logging
+import math
+import multiprocessing
+import os
+import sqlite3
+import struct
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from photohop.config import cache_dir
+from photohop.imaging import ImageMetadata, exif_timestamp
+from photohop.index import collection_key
+
+debug = logging.debug
+
+# Number of photos read between commits to the database
+BATCH_SIZE = 1000
+
+# JPEG start-of-frame markers, which give the image size
+SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+class MetadataStore(object):
+    """
+    Metadata of photos, keyed by their dir relative to the collection root
+    and their filename. Each entry records the mtime of the file it was
+    read from, so it's ignored if the file has changed since. Photos whose
+    headers couldn't be read are stored with no metadata, so they're not
+    read again until they change.
+
+    A store should only be used from the thread that opened it.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        # Let the UI read while the background job is writing
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS photos (
+                rel_dir TEXT, filename TEXT, mtime REAL,
+                orientation INTEGER, taken REAL, width INTEGER, height INTEGER,
+                PRIMARY KEY (rel_dir, filename)
+            )
+        """)
+        self.conn.commit()
+
+    @staticmethod
+    def for_collection(root_dir):
+        return MetadataStore(default_metadata_path(root_dir))
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, rel_dir, filename, mtime):
+        """
+        Returns an ImageMetadata, or None if the file's not in the store, has
+        changed, or its header couldn't be fully read
+
+        """
+        row = self.conn.execute(
+            "SELECT mtime, orientation, taken, width, height FROM photos WHERE rel_dir=? AND filename=?",
+            (rel_dir, filename)
+        ).fetchone()
+        if row is None or row[0] != mtime:
+            return None
+        _, orientation, taken, width, height = row
+        if width is None:
+            # Leave it to the loader to read what it can
+            return None
+        return ImageMetadata(
+            orientation,
+            None if taken is None else datetime.datetime.fromtimestamp(taken),
+            (width, height),
+        )
+
+    def dir_mtimes(self, rel_dir):
+        """ Mapping from filename to the mtime stored for it, for a whole dir """
+        return dict(self.conn.execute("SELECT filename, mtime FROM photos WHERE rel_dir=?", (rel_dir,)))
+
+    def put_many(self, entries):
+        """
+        Store (rel_dir, filename, mtime, ImageMetadata) entries. The metadata
+        may be None, for files whose headers couldn't be read.
+
+        """
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (rel_dir, filename, mtime, None, None, None, None) if metadata is None else
+                (rel_dir, filename, mtime, metadata.orientation,
+                 None if metadata.timestamp is None else time.mktime(metadata.timestamp.timetuple()),
+                 *(metadata.size or (None, None)))
+                for (rel_dir, filename, mtime, metadata) in entries
+            ]
+        )
+        self.conn.commit()
+
+    def capture_dates(self, index):
+        """
+        Capture dates (as timestamps) of all the photos in the index, in an
+        array indexed by file id. Photos with no date stored are NaN.
+
+        """
+        dates = array("d", [math.nan]) * index.num_photos
+        rows = self.conn.execute("SELECT rel_dir, filename, mtime, taken FROM photos ORDER BY rel_dir")
+        current_dir = file_ids = None
+        for rel_dir, filename, mtime, taken in rows:
+            if rel_dir != current_dir:
+                # Look up the ids of one dir's files at a time
+                current_dir = rel_dir
+                dir_id = index.dir_ids.get(rel_dir)
+                file_ids = {} if dir_id is None else \
+                    dict((index.file_name(f), f) for f in index.dir_files(dir_id))
+            file_id = file_ids.get(filename)
+            if file_id is not None and taken is not None and mtime == index.file_mtime(file_id):
+                dates[file_id] = taken
+        return dates
+
+
+def default_metadata_path(root_dir):
+    return os.path.join(cache_dir(), "metadata", "{}.sqlite".format(collection_key(root_dir)))
+
+
+def capture_date_function(index):
+    """
+    Function from file id to the photo's capture date, where it's in the
+    metadata store, or its mtime otherwise. For date-based selection
+
+    """
+    path = default_metadata_path(index.root_dir)
+    if not os.path.exists(path):
+        return index.file_mtime
+    store = MetadataStore(path)
+    try:
+        dates = store.capture_dates(index)
+    finally:
+        store.close()
+
+    def capture_date(file_id):
+        date = dates[file_id]
+        return index.file_mtime(file_id) if math.isnan(date) else date
+    return capture_date
+
+
+def update_metadata(index, path=None, workers=None, stop=None):
+    """
+    Read the metadata of every photo in the index that isn't already in the
+    store, or has changed since it was read, using a pool of worker
+    processes. Results are committed in batches, so if this is interrupted
+    (or stopped by setting the threading.Event stop), little is lost.
+
+    Returns the number of photos read.
+
+    """
+    store = MetadataStore(path or default_metadata_path(index.root_dir))
+    # Use fresh processes, rather than forking a process that has a UI running
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    num_read = 0
+    try:
+        for batch in _batches(_photos_to_read(index, store), BATCH_SIZE):
+            if stop is not None and stop.is_set():
+                break
+            paths = [os.path.join(index.root_dir, rel_dir, filename) for (rel_dir, filename, _) in batch]
+            results = pool.map(read_header, paths, chunksize=50)
+            # Unreadable photos are stored too, so they're skipped next time
+            store.put_many(
+                (rel_dir, filename, mtime, metadata)
+                for ((rel_dir, filename, mtime), metadata) in zip(batch, results)
+            )
+            num_read += len(batch)
+            debug("read metadata of %d photos", num_read)
+    finally:
+        pool.shutdown(cancel_futures=True)
+        store.close()
+    return num_read
+
+
+def _photos_to_read(index, store):
+    """ Generates (rel_dir, filename, mtime) for photos whose metadata is missing or out of date """
+    for dir_id in range(index.num_dirs):
+        file_ids = index.dir_files(dir_id)
+        if not len(file_ids):
+            continue
+        rel_dir = index.dir_name(dir_id)
+        stored = store.dir_mtimes(rel_dir)
+        for file_id in file_ids:
+            filename = index.file_name(file_id)
+            mtime = index.file_mtime(file_id)
+            if stored.get(filename) != mtime:
+                yield rel_dir, filename, mtime
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_header(path):
+    """
+    Read an ImageMetadata from just the header of a JPEG or PNG file,
+    without decoding the image. Returns None if the file can't be read.
+
+    """
+    try:
+        with open(path, "rb") as f:
+            start = f.read(8)
+            if start[:2] == b"\xff\xd8":
+                f.seek(2)
+                return _read_jpeg_header(f)
+            elif start == b"\x89PNG\r\n\x1a\n":
+                # IHDR is always the first chunk
+                width, height = struct.unpack(">II", f.read(16)[8:16])
+                return ImageMetadata(None, None, (width, height))
+    except (OSError, struct.error, ValueError, IndexError) as e:
+        debug("could not read header of %s: %s", path, e)
+    return None
+
+
+def _read_jpeg_header(f):
+    orientation = timestamp = size = None
+    while size is None:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        code = marker[1]
+        while code == 0xFF:
+            # Padding before a marker
+            code = f.read(1)[0]
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            # No length or data
+            continue
+        if code in (0xD9, 0xDA):
+            # End of image, or start of the image data, with no size found
+            break
+        length = struct.unpack(">H", f.read(2))[0]
+        if code == 0xE1 and orientation is None and timestamp is None:
+            data = f.read(length - 2)
+            if data[:6] == b"Exif\x00\x00":
+                orientation, timestamp = _parse_exif(data[6:])
+        elif code in SOF_MARKERS:
+            height, width = struct.unpack(">HH", f.read(5)[1:5])
+            size = (width, height)
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+    return ImageMetadata(orientation, timestamp, size)
+
+
+def _parse_exif(data):
+    """ Get the orientation and DateTime from the first IFD of a TIFF-format EXIF block """
+    endian = "<" if data[:2] == b"II" else ">"
+    ifd = struct.unpack(endian + "I", data[4:8])[0]
+    num_entries = struct.unpack(endian + "H", data[ifd:ifd + 2])[0]
+    orientation = timestamp = None
+    for i in range(num_entries):
+        entry = data[ifd + 2 + 12 * i:ifd + 14 + 12 * i]
+        tag, _, count = struct.unpack(endian + "HHI", entry[:8])
+        if tag == 0x0112:
+            orientation = struct.unpack(endian + "H", entry[8:10])[0]
+        elif tag == 0x0132:
+            # ASCII string, too long to fit in the entry, so stored at an offset
+            offset = struct.unpack(endian + "I", entry[8:12])[0]
+            value = data[offset:offset + count].rstrip(b"\x00").decode("ascii", "replace")
+            timestamp = exif_timestamp(value)
+    return orientation, timestamp
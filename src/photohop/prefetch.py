@@ -0,0 +1,98 @@
+"""
+Background loading of the images that are likely to be shown next.
+
+"""
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from photohop.cache import ImageCache
+from photohop.imaging import load_image, rescale_loaded
+
+debug = logging.debug
+
+
+class Prefetcher(object):
+    """
+    Loads images on a pool of worker threads, so that by the time they're
+    shown they have already been read, decoded and resized.
+
+    Loaded images go into an ImageCache, identified by their path, mtime,
+    the size they're to fit and their rotation. When an image is needed at a
+    size or rotation it's not been loaded at, it's made from one that has
+    been, if possible, so that resizing the window or rotating the image
+    doesn't need the file to be read again.
+
+    At most max_pending images are waiting to be loaded at once: requesting
+    more than that drops the least recently requested.
+
+    If a PreviewCache is given, images are loaded through it, rather than
+    always from the original files.
+
+    """
+    def __init__(self, workers=2, max_pending=8, cache=None, load=load_image, previews=None):
+        self.max_pending = max_pending
+        self.cache = cache if cache is not None else ImageCache(256 * 1024 * 1024)
+        self.load = load
+        self.previews = previews
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self._futures = OrderedDict()
+
+    def prefetch(self, path, mtime, size, rotation=0, metadata=None):
+        """
+        Start loading an image in the background, if it's not already loaded.
+        Pass in the image's metadata if it's already known.
+
+        """
+        key = (path, mtime, size, rotation)
+        # Forget about loads that have finished: they're in the cache now
+        for done_key in [k for (k, f) in self._futures.items() if f.done()]:
+            del self._futures[done_key]
+        if key in self._futures:
+            self._futures.move_to_end(key)
+            return
+        if key in self.cache:
+            return
+        debug("prefetch %r", path)
+        future = self._pool.submit(self._load, path, mtime, size, rotation, metadata)
+        future.add_done_callback(lambda f: self._loaded(key, f))
+        self._futures[key] = future
+        while len(self._futures) > self.max_pending:
+            _, future = self._futures.popitem(last=False)
+            future.cancel()
+
+    def _loaded(self, key, future):
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(key, future.result())
+
+    def get(self, path, mtime, size, rotation=0, metadata=None):
+        """
+        Get a LoadedImage. If it's being prefetched, this waits for it to
+        finish loading. If it's not been loaded at all, it's loaded right away.
+
+        """
+        key = (path, mtime, size, rotation)
+        loaded = self.cache.get(key)
+        if loaded is not None:
+            return loaded
+        future = self._futures.get(key)
+        if future is not None and not future.cancelled():
+            return future.result()
+        # See if we can make it from the image at another size or rotation
+        for (_, _, _, other_rotation), other in self.cache.variants(path, mtime):
+            loaded = rescale_loaded(other, size, (rotation - other_rotation) % 360)
+            if loaded is not None:
+                break
+        else:
+            loaded = self._load(path, mtime, size, rotation, metadata)
+        self.cache.put(key, loaded)
+        return loaded
+
+    def _load(self, path, mtime, size, rotation, metadata):
+        if self.previews is not None:
+            return self.previews.load(path, mtime, size, rotation, metadata)
+        return self.load(path, size, rotation, metadata)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._futures.clear()
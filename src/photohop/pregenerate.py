@@ -0,0 +1,227 @@
+"""
+Make previews of the whole collection ahead of time, so that slideshows
+never need to read the originals.
+
+Meant to be left running overnight on the machine that holds the photos.
+It doesn't need a display. Previews that already exist are skipped, so if
+it's interrupted, running it again carries on where it left off:
+  PYTHONPATH=$PYTHONPATH:./src python3 -m photohop.pregenerate /path/to/photos
+
+The preview cache has to be big enough to hold previews of the whole
+collection, or they'd be evicted as fast as they're made. The budget is
+preview_cache_bytes from the config, unless --max-bytes is given, and it
+won't start if that looks too small. It's recorded in the preview
+directory, so slideshows using it never shrink it below that, whatever
+their own preview_cache_bytes.
+
+Previews go in preview_dir from the config, or --preview-dir. They're
+named by photos' paths within the collection, so a directory on the share
+itself can be used by every machine, wherever they mount it.
+
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from photohop.config import Config
+from photohop.index import CollectionIndex
+from photohop.metadata import MetadataStore, default_metadata_path
+from photohop.previews import PREVIEW_TIERS, PreviewCache, fits_tier
+
+# How often to report progress, in seconds
+PROGRESS_INTERVAL = 5.
+# Rough size of a preview, per pixel of its tier, for checking the
+# collection will fit in the cache. A 1920x1200 preview is about 300 KB
+PREVIEW_BYTES_PER_PIXEL = 0.15
+
+# The preview cache of each worker process
+_previews = None
+
+
+def pregenerate(root_dir, exclude=[], tiers=None, workers=2, max_read_rate=None, max_bytes=None,
+                preview_dir=None):
+    """
+    Make previews at each of the tiers for every photo in the collection
+    that doesn't have them yet, on a pool of worker processes.
+
+    max_read_rate limits how fast originals are read, in bytes per second,
+    to leave the disk for everything else. Returns the number of previews
+    made.
+
+    max_bytes is the size of the preview cache and preview_dir where it's
+    kept, both defaulting to the configured ones. Raises ValueError if
+    it's unlikely to hold previews of the whole collection.
+
+    """
+    if tiers is None:
+        tiers = [PREVIEW_TIERS[1]]
+    config = Config.load()
+    if max_bytes is None:
+        max_bytes = config["preview_cache_bytes"]
+    if preview_dir is None:
+        preview_dir = config["preview_dir"]
+    if not max_bytes:
+        raise ValueError("the preview cache is turned off (its size is 0)")
+    index = CollectionIndex.load(root_dir, exclude, refresh=True)
+    needed = estimate_bytes(index.num_photos, tiers)
+    if needed > max_bytes:
+        raise ValueError(
+            "previews of {} photos need about {:,.0f} MB, more than the preview cache's {:,.0f} MB: "
+            "they would be evicted before the end".format(
+                index.num_photos, needed / 1024 ** 2, max_bytes / 1024 ** 2
+            )
+        )
+    previews = PreviewCache.default(max_bytes, root_dir, preview_dir)
+    # So that slideshows don't evict what's made here
+    previews.record_budget(max_bytes)
+    # Photos' sizes, if the slideshow's read them already, so those that
+    # are small enough not to need previews can be skipped
+    metadata_path = default_metadata_path(root_dir)
+    store = MetadataStore(metadata_path) if os.path.exists(metadata_path) else None
+
+    total = index.num_photos * len(tiers)
+    progress = Progress(total)
+    # Keep just enough work queued to keep the workers busy
+    max_queued = workers * 2
+    pool = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker, initargs=(max_bytes, root_dir, preview_dir)
+    )
+    pending = set()
+    start = time.monotonic()
+    bytes_read = 0
+    try:
+        for file_id in range(index.num_photos):
+            rel_dir, filename = index.dir_name(index.file_dirs[file_id]), index.file_name(file_id)
+            path = os.path.join(root_dir, rel_dir, filename)
+            mtime = index.file_mtime(file_id)
+            metadata = None if store is None or mtime is None else store.get(rel_dir, filename, mtime)
+            for tier in tiers:
+                if mtime is None or (metadata is not None and fits_tier(metadata, tier)) or \
+                        previews.has_preview(path, mtime, tier):
+                    progress.skipped += 1
+                    continue
+                while len(pending) >= max_queued:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        bytes_read += future.result()
+                        progress.made += 1
+                    progress.report()
+                if max_read_rate:
+                    # Wait until the average rate drops back to the limit
+                    delay = bytes_read / max_read_rate - (time.monotonic() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+                pending.add(pool.submit(_make_preview, path, mtime, tier, metadata))
+        for future in pending:
+            future.result()
+            progress.made += 1
+        progress.report(final=True)
+    except KeyboardInterrupt:
+        print("\nInterrupted: run again to carry on from here", file=sys.stderr)
+    finally:
+        pool.shutdown(cancel_futures=True)
+        if store is not None:
+            store.close()
+    return progress.made
+
+
+def estimate_bytes(num_photos, tiers):
+    """ Roughly how much space previews of this many photos at these tiers take """
+    return int(num_photos * sum(w * h * PREVIEW_BYTES_PER_PIXEL for (w, h) in tiers))
+
+
+def _init_worker(max_bytes, root_dir, preview_dir):
+    global _previews
+    _previews = PreviewCache.default(max_bytes, root_dir, preview_dir)
+    # Stay out of the way of anything interactive
+    os.nice(10)
+
+
+def _make_preview(path, mtime, tier, metadata=None):
+    """ Returns the number of bytes read from the original """
+    try:
+        _previews.make_preview(path, mtime, tier, metadata)
+        return os.path.getsize(path)
+    except Exception as e:
+        # One bad photo shouldn't stop the rest
+        logging.warning("could not make preview of %s: %s", path, e)
+        return 0
+
+
+class Progress(object):
+    """ Reports how many previews have been made, and how long the rest will take """
+    def __init__(self, total):
+        self.total = total
+        self.made = 0
+        self.skipped = 0
+        self.start = time.monotonic()
+        self._last_report = self.start
+
+    def report(self, final=False):
+        now = time.monotonic()
+        if not final and now - self._last_report < PROGRESS_INTERVAL:
+            return
+        self._last_report = now
+        done = self.made + self.skipped
+        rate = self.made / (now - self.start) if now > self.start else 0.
+        if rate > 0:
+            eta = format_duration((self.total - done) / rate)
+        else:
+            eta = "unknown"
+        print("{}/{} previews ({:.1f}%), {} made, {:.1f}/s, ETA {}".format(
+            done, self.total, 100. * done / self.total if self.total else 100., self.made, rate, eta
+        ), file=sys.stderr)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{}h{:02d}m".format(hours, minutes)
+    return "{}m{:02d}s".format(minutes, seconds)
+
+
+def parse_size(text):
+    w, _, h = text.partition("x")
+    return int(w), int(h)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("photo_root", help="Root directory of the photo collection")
+    parser.add_argument("--exclude", nargs="*", default=[], help="Immediate subdirectories to leave out")
+    parser.add_argument(
+        "--tier", action="append", type=parse_size,
+        help="Preview size to make, as WxH. One of: {}. Default: {}x{}. May be given more than once".format(
+            ", ".join("{}x{}".format(*t) for t in PREVIEW_TIERS), *PREVIEW_TIERS[1]
+        )
+    )
+    parser.add_argument("--workers", type=int, default=2, help="Number of worker processes")
+    parser.add_argument("--max-read-mb", type=float, help="Limit on MB/s read from the originals")
+    parser.add_argument(
+        "--max-bytes", type=int,
+        help="Size of the preview cache, in bytes. Default: preview_cache_bytes from the config. It needs to be "
+             "big enough for the whole collection, or previews will be evicted while it runs"
+    )
+    parser.add_argument("--preview-dir", help="Directory to keep previews in. Default: preview_dir from the config")
+    opts = parser.parse_args()
+
+    for tier in opts.tier or []:
+        if tier not in PREVIEW_TIERS:
+            parser.error("unknown preview size {}x{}".format(*tier))
+    max_read_rate = opts.max_read_mb * 1024 * 1024 if opts.max_read_mb else None
+    try:
+        pregenerate(
+            opts.photo_root, opts.exclude, opts.tier, opts.workers, max_read_rate, opts.max_bytes, opts.preview_dir
+        )
+    except ValueError as e:
+        parser.error("{}. Use --max-bytes to give a bigger cache".format(e))
+
+
+if __name__ == "__main__":
+    main()
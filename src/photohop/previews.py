@@ -0,0 +1,291 @@
+"""
+On-disk cache of downscaled copies of photos, shared by every session.
+
+Reading a 12 MB original from the photo share and decoding it is most of
+the cost of showing a photo. A preview, the photo shrunk to fit one of a
+few screen sizes and turned upright, is a few hundred KB and much faster
+to decode, so once a photo's been shown it can be shown again from its
+preview.
+
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from PIL import Image
+
+from photohop.config import cache_dir
+from photohop.imaging import EXIF_ORIENTATIONS, ImageMetadata, LoadedImage, load_image, rescale_loaded
+
+debug = logging.debug
+
+# Sizes previews are made at. A photo is shown from the smallest one
+# that's at least as big as the window
+PREVIEW_TIERS = [(1280, 800), (1920, 1200), (2560, 1600), (3840, 2400)]
+PREVIEW_QUALITY = 88
+# When over budget, evict down to this fraction of it, so that eviction
+# doesn't happen at every write
+EVICT_TO = 0.9
+# File in the cache directory recording the size it's meant to be allowed
+# to grow to, by whatever filled it
+BUDGET_FILENAME = "budget.json"
+
+
+class PreviewCache(object):
+    """
+    Previews kept in a directory, named by a hash of the original's path,
+    mtime and the preview tier, so they're never used for a file that's
+    changed since. If root_dir is given, the path is taken relative to it,
+    so that machines mounting the collection in different places can
+    share the directory.
+
+    The directory is limited to max_bytes, evicting the least recently
+    used previews: showing a preview updates its mtime, so the oldest go
+    first. Previews are written to a temporary file and renamed, so that
+    several instances can share the cache without seeing partial files.
+    A budget recorded in the directory (see record_budget()), by
+    pregenerate, say, overrides a smaller max_bytes, so that previews made
+    ahead of time aren't evicted by the first slideshow.
+
+    Adding up the size of the directory and evicting both mean looking at
+    every preview, which can take seconds for a big cache, so they're
+    done on a background thread, never holding up a write.
+
+    """
+    def __init__(self, directory, max_bytes, root_dir=None):
+        self.directory = directory
+        self.max_bytes = max(max_bytes, self.recorded_budget())
+        self.root_dir = root_dir
+        self.hits = 0
+        self.misses = 0
+        # Total size of the directory, worked out in the background after
+        # the first write and then kept up to date with our own writes
+        self._total_bytes = None
+        # Whether the size is being worked out, or previews evicted
+        self._housekeeping = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def default(max_bytes, root_dir=None, directory=None):
+        """ A PreviewCache in directory, or if that's None, in the user's cache dir """
+        if directory is None:
+            directory = os.path.join(cache_dir(), "previews")
+        return PreviewCache(directory, max_bytes, root_dir)
+
+    def recorded_budget(self):
+        """ The budget recorded in the directory, or 0 if there isn't one """
+        try:
+            with open(os.path.join(self.directory, BUDGET_FILENAME), encoding="utf-8") as f:
+                return int(json.load(f)["max_bytes"])
+        except FileNotFoundError:
+            return 0
+        except (OSError, KeyError, TypeError, ValueError) as e:
+            debug("could not read preview cache budget: %s", e)
+            return 0
+
+    def record_budget(self, max_bytes):
+        """
+        Record a new budget in the directory, replacing any there already,
+        so that every PreviewCache using it keeps it at least this big
+
+        """
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"max_bytes": self.max_bytes}, f)
+            os.replace(tmp_path, os.path.join(self.directory, BUDGET_FILENAME))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def preview_path(self, path, mtime, tier):
+        path = os.path.abspath(path)
+        if self.root_dir is not None:
+            path = os.path.relpath(path, os.path.abspath(self.root_dir))
+        key = "{}\0{!r}\0{}x{}".format(path, mtime, *tier)
+        digest = hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + ".jpg")
+
+    def load(self, path, mtime, size, rotation=0, metadata=None):
+        """
+        Load an image to fit size, like imaging.load_image, from its preview
+        if there is one, or otherwise from the original, making a preview.
+        Images bigger than every tier are always loaded from the original,
+        as are originals that already fit in the tier, which a preview
+        would only make worse.
+
+        """
+        tier = preview_tier(size, rotation)
+        if tier is None or mtime is None or (metadata is not None and fits_tier(metadata, tier)):
+            return load_image(path, size, rotation, metadata)
+        preview_path = self.preview_path(path, mtime, tier)
+        preview = self._read(preview_path)
+        if preview is None:
+            self.misses += 1
+            preview = load_image(path, tier, 0, metadata)
+            # Not shrunk, so it's the original as it is
+            if not fits_tier(preview.metadata, tier):
+                self._write(preview_path, preview)
+        else:
+            self.hits += 1
+        loaded = rescale_loaded(preview, size, rotation)
+        if loaded is None:
+            # The preview's somehow smaller than it should be
+            return load_image(path, size, rotation, metadata)
+        return loaded
+
+    def has_preview(self, path, mtime, tier):
+        return os.path.exists(self.preview_path(path, mtime, tier))
+
+    def make_preview(self, path, mtime, tier, metadata=None):
+        """
+        Make a preview at this tier, if there's not one already and the
+        original doesn't fit in the tier anyway
+
+        """
+        preview_path = self.preview_path(path, mtime, tier)
+        if not os.path.exists(preview_path) and (metadata is None or not fits_tier(metadata, tier)):
+            loaded = load_image(path, tier, 0, metadata)
+            if not fits_tier(loaded.metadata, tier):
+                self._write(preview_path, loaded)
+
+    def _read(self, preview_path):
+        try:
+            image = Image.open(preview_path)
+            image.load()
+            info = json.loads(image.info["comment"])
+        except (OSError, KeyError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                debug("could not read preview %s: %s", preview_path, e)
+            return None
+        try:
+            # Mark it as recently used
+            os.utime(preview_path)
+        except OSError:
+            pass
+        timestamp = info["timestamp"]
+        metadata = ImageMetadata(
+            info["orientation"],
+            None if timestamp is None else datetime.datetime.fromisoformat(timestamp),
+            tuple(info["size"]),
+        )
+        return LoadedImage(image, metadata, tuple(info["full_size"]))
+
+    def _write(self, preview_path, loaded):
+        if loaded.image is None or loaded.image.mode not in ("RGB", "L"):
+            # Nothing to store, or it has transparency JPEG can't keep
+            return
+        metadata = loaded.metadata
+        # The original's metadata goes in the JPEG comment, so a preview
+        # can stand in for the original without the original being read
+        info = json.dumps({
+            "orientation": metadata.orientation,
+            "timestamp": None if metadata.timestamp is None else metadata.timestamp.isoformat(),
+            "size": metadata.size,
+            "full_size": loaded.full_size,
+        })
+        preview_dir = os.path.dirname(preview_path)
+        try:
+            os.makedirs(preview_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=preview_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    loaded.image.save(f, "JPEG", quality=PREVIEW_QUALITY, comment=info.encode("utf-8"))
+                nbytes = os.path.getsize(tmp_path)
+                os.replace(tmp_path, preview_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        except OSError as e:
+            debug("could not write preview %s: %s", preview_path, e)
+            return
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += nbytes
+            start = not self._housekeeping and (self._total_bytes is None or self._total_bytes > self.max_bytes)
+            if start:
+                self._housekeeping = True
+        if start:
+            threading.Thread(target=self._housekeep, name="previews", daemon=True).start()
+
+    def _housekeep(self):
+        """ Work out the size of the directory, evicting previews if it's over budget """
+        try:
+            # Look at the directory again, since other instances write to it too
+            files = self._files()
+            total = sum(size for (_, _, size) in files)
+            if total > self.max_bytes:
+                total = self._evict(files, total)
+            with self._lock:
+                self._total_bytes = total
+        finally:
+            with self._lock:
+                self._housekeeping = False
+
+    def _files(self):
+        """ (mtime, path, size) of every preview """
+        files = []
+        try:
+            subdirs = list(os.scandir(self.directory))
+        except OSError:
+            return files
+        for subdir in subdirs:
+            if not subdir.is_dir():
+                continue
+            try:
+                for entry in os.scandir(subdir.path):
+                    if entry.name.endswith(".jpg"):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, entry.path, stat.st_size))
+            except OSError:
+                # Another instance may be evicting at the same time
+                continue
+        return files
+
+    def _evict(self, files, total):
+        """ Remove the least recently used previews, until under budget. Returns the new total """
+        target = self.max_bytes * EVICT_TO
+        removed = 0
+        for (_, path, size) in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            removed += 1
+        debug("evicted %d previews", removed)
+        return total
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes": self._total_bytes}
+
+
+def fits_tier(metadata, tier):
+    """ Whether an original, once turned upright, is no bigger than the tier """
+    if metadata.size is None:
+        return False
+    w, h = metadata.size
+    if EXIF_ORIENTATIONS.get(metadata.orientation, (False, 0))[1] in (90, 270):
+        w, h = h, w
+    return w <= tier[0] and h <= tier[1]
+
+
+def preview_tier(size, rotation=0):
+    """
+    The smallest preview tier that holds a window of this size (turned by
+    rotation, since previews are upright), or None if none are big enough
+
+    """
+    w, h = size[::-1] if rotation in (90, 270) else size
+    for tier in PREVIEW_TIERS:
+        if tier[0] >= w and tier[1] >= h:
+            return tier
+    return None
@@ -0,0 +1,125 @@
+"""
+Recording where time and memory go over a whole slideshow session, for
+looking into later.
+
+Turned on by setting profile_dir in the config, or the PHOTOHOP_PROFILE
+environment variable to a directory. Each session writes to its own
+subdirectory:
+
+  profile.pstats          cProfile stats for the UI thread: view them with
+                          python -m pstats, or snakeviz
+  snapshot-NNNN.tracemalloc
+                          tracemalloc snapshots, every profile_snapshot_seconds,
+                          to load with tracemalloc.Snapshot.load()
+  memory.log              traced memory and counters at each snapshot
+  memory_growth.txt       where memory grew most, from the first snapshot
+                          to the last
+
+Only the thread that starts the profiler (the UI thread) is profiled:
+the time spent loading images in the background is better seen with
+telemetry (see photohop.telemetry).
+
+"""
+import cProfile
+import gc
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+debug = logging.debug
+
+ENV_VAR = "PHOTOHOP_PROFILE"
+# Frames of traceback kept for each memory allocation
+TRACEBACK_FRAMES = 10
+
+
+class Profiler(object):
+    """
+    Profiles the calling thread and takes snapshots of memory allocations
+    every snapshot_interval seconds between start() and stop().
+
+    counters maps names to functions giving numbers to log with every
+    snapshot, like the length of a list suspected of growing.
+
+    """
+    def __init__(self, directory, snapshot_interval=60., counters=None):
+        self.directory = directory
+        self.snapshot_interval = snapshot_interval
+        self.counters = dict(counters or {})
+        self._profile = cProfile.Profile()
+        self._snapshots = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(config):
+        """ A Profiler writing to a new dir for this session, or None if profiling is off """
+        directory = os.environ.get(ENV_VAR) or config["profile_dir"]
+        if not directory:
+            return None
+        return Profiler(
+            os.path.join(directory, time.strftime("%Y%m%d-%H%M%S")),
+            snapshot_interval=config["profile_snapshot_seconds"],
+        )
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        print("Profiling: writing to {}".format(self.directory))
+        tracemalloc.start(TRACEBACK_FRAMES)
+        self._snapshot()
+        self._thread = threading.Thread(target=self._take_snapshots, name="profiler", daemon=True)
+        self._thread.start()
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        self._stop.set()
+        self._thread.join()
+        self._profile.dump_stats(os.path.join(self.directory, "profile.pstats"))
+        self._snapshot()
+        tracemalloc.stop()
+        self._write_growth()
+        print("Profiling: written to {}".format(self.directory))
+
+    def _take_snapshots(self):
+        while not self._stop.wait(self.snapshot_interval):
+            self._snapshot()
+
+    def _snapshot(self):
+        with self._lock:
+            snapshot = tracemalloc.take_snapshot()
+            path = os.path.join(self.directory, "snapshot-{:04d}.tracemalloc".format(len(self._snapshots)))
+            snapshot.dump(path)
+            self._snapshots.append(path)
+            current, peak = tracemalloc.get_traced_memory()
+            fields = ["{:.0f}".format(time.time()), "current={}".format(current), "peak={}".format(peak)]
+            for name, counter in sorted(self.counters.items()):
+                try:
+                    fields.append("{}={}".format(name, counter()))
+                except Exception as e:
+                    debug("profiling counter %s failed: %s", name, e)
+            with open(os.path.join(self.directory, "memory.log"), "a") as f:
+                f.write(" ".join(fields) + "\n")
+
+    def _write_growth(self, limit=30):
+        """ Compare the first and last snapshots, to show where memory has been piling up """
+        first = tracemalloc.Snapshot.load(self._snapshots[0])
+        last = tracemalloc.Snapshot.load(self._snapshots[-1])
+        with open(os.path.join(self.directory, "memory_growth.txt"), "w") as f:
+            for stat in last.compare_to(first, "traceback")[:limit]:
+                f.write("{}\n".format(stat))
+                for line in stat.traceback.format():
+                    f.write("    {}\n".format(line))
+
+
+def count_instances(cls):
+    """
+    A counter for a Profiler, giving the number of live objects of a class.
+    Goes through every object, so it's slow with a lot of them, but only
+    runs once per snapshot.
+
+    """
+    return lambda: sum(1 for obj in gc.get_objects() if isinstance(obj, cls))
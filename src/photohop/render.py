@@ -0,0 +1,93 @@
+"""
+Turning photos into images ready to display, independent of any UI.
+
+The Renderer brings together loading (imaging), the in-memory and
+on-disk caches and prefetching, so that a slideshow only has to ask for
+a photo at the size of its window and hand the result to its toolkit.
+Since nothing here needs a display, it can also be timed and profiled on
+its own (see bench/bench_render.py).
+
+"""
+import logging
+
+from photohop.cache import ImageCache
+from photohop.imaging import load_image
+from photohop.prefetch import Prefetcher
+from photohop.previews import PreviewCache
+from photohop.telemetry import telemetry
+
+debug = logging.debug
+
+
+class Renderer(object):
+    """
+    Renders SelectedPhotos to fit a size, after rotating them by a
+    multiple of 90 degrees, returning LoadedImages.
+
+    If a MetadataStore is given, photos' metadata is taken from it where
+    possible, rather than read from their files.
+
+    Previews are kept in preview_dir (by default, in the user's cache dir),
+    keyed by photos' paths relative to root_dir, if it's given.
+
+    """
+    def __init__(self, cache_bytes=256 * 1024 * 1024, prefetch_workers=2, prefetch_count=3,
+                 preview_cache_bytes=0, metadata_store=None, load=load_image, root_dir=None, preview_dir=None):
+        self.cache = ImageCache(cache_bytes)
+        # Previews of photos already shown, kept on disk between sessions
+        if preview_cache_bytes:
+            self.previews = PreviewCache.default(preview_cache_bytes, root_dir, preview_dir)
+        else:
+            self.previews = None
+        self.prefetcher = Prefetcher(
+            workers=prefetch_workers, max_pending=prefetch_count + 3, cache=self.cache, load=load,
+            previews=self.previews
+        )
+        self.metadata_store = metadata_store
+
+    @staticmethod
+    def from_config(config, metadata_store=None, root_dir=None):
+        return Renderer(
+            cache_bytes=config["image_cache_bytes"],
+            prefetch_workers=config["prefetch_workers"],
+            prefetch_count=config["prefetch_count"],
+            preview_cache_bytes=config["preview_cache_bytes"],
+            metadata_store=metadata_store,
+            root_dir=root_dir,
+            preview_dir=config["preview_dir"],
+        )
+
+    def render(self, photo, size, rotation=0):
+        """
+        Get a photo ready to show in a window of this size. The photo's
+        metadata is filled in. Raises OSError if the file can't be loaded.
+
+        """
+        self._fill_metadata(photo)
+        debug("render %r", photo.abs_path)
+        # Includes waiting for a prefetch to finish, or the time to load
+        # from a preview, so the other spans don't add up to this
+        with telemetry.span("render"):
+            loaded = self.prefetcher.get(photo.abs_path, photo.mtime, size, rotation, photo.metadata)
+        # Keep the metadata, so it doesn't need reading again
+        photo.metadata = loaded.metadata
+        return loaded
+
+    def prefetch(self, photo, size, rotation=0):
+        """ Start rendering a photo in the background, ready for when it's needed """
+        self._fill_metadata(photo)
+        self.prefetcher.prefetch(photo.abs_path, photo.mtime, size, rotation, metadata=photo.metadata)
+
+    def _fill_metadata(self, photo):
+        """ Get a photo's metadata from the store, if it's been read already """
+        if photo.metadata is None and photo.file_id is not None and self.metadata_store is not None:
+            photo.metadata = self.metadata_store.get(photo.rel_dir, photo.filename, photo.mtime)
+
+    def stats(self):
+        stats = {"image_cache": self.cache.stats()}
+        if self.previews is not None:
+            stats["previews"] = self.previews.stats()
+        return stats
+
+    def shutdown(self):
+        self.prefetcher.shutdown()
@@ -21,6 +21,15 @@ history = os.path.join(os.getcwd(), "viewing_history.txt")
 # Command to open file manager on current image
 # Can also be left off if you don't want this feature
 file_manager_cmd = "nemo {image}"
+# The collection index is stored between runs, so the whole collection
+# doesn't need to be walked every time. Set this to walk it again
+rebuild_index = False
+# Check for changes since the index was stored, only re-listing dirs
+# that have been modified. Done in the background, so the changes are
+# only in the index from the next run
+refresh_index = True
 
-# Set the slideshow going
-random_slideshow(exclude=exclude)
+# Set the slideshow going. Only when run as the main script: the
+# background metadata reader starts processes that import this module
+if __name__ == "__main__":
+    random_slideshow(exclude=exclude, rebuild_index=rebuild_index, refresh_index=refresh_index)
@@ -0,0 +1,138 @@
+"""
+Which photos in a collection have been seen before, according to the
+viewing history, so that the selector can avoid showing them again.
+
+The photos seen are held as a bitmap over the index's file ids: one bit
+per photo. It's kept in the cache dir along with how far through the
+history file it's got, so at startup only the history written since
+last time needs reading. If the index has just been refreshed and its
+ids have changed, the bitmap is carried over to the new ids. Only if it
+can't be is it built again from the whole history.
+
+"""
+import logging
+import os
+import pickle
+
+from photohop.config import cache_dir
+from photohop.history import ENCODING, SESSION_PREFIX
+from photohop.index import collection_key
+
+debug = logging.debug
+
+
+class SeenPhotos(object):
+    """ Set of file ids, as a bitmap """
+    def __init__(self, num_photos, bits=None):
+        self.num_photos = num_photos
+        if bits is None:
+            bits = bytearray((num_photos + 7) // 8)
+        self.bits = bits
+
+    def add(self, file_id):
+        self.bits[file_id >> 3] |= 1 << (file_id & 7)
+
+    def __contains__(self, file_id):
+        return bool(self.bits[file_id >> 3] & (1 << (file_id & 7)))
+
+    def __len__(self):
+        return sum(bin(byte).count("1") for byte in self.bits)
+
+
+def load_seen(index, history_path, path=None):
+    """
+    Get the SeenPhotos for the photos in the index that are in the
+    history file, updating the stored copy with anything new.
+
+    """
+    if path is None:
+        path = default_seen_path(index.root_dir)
+    history_path = os.path.abspath(history_path)
+    seen = None
+    offset = 0
+    # Whether the stored copy needs updating, even if there's no new history
+    renumbered = False
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except Exception as e:
+            logging.warning("could not read seen photos {}: {}".format(path, e))
+        else:
+            if data["history_path"] != history_path:
+                pass
+            elif data["index_token"] == index.token:
+                seen = SeenPhotos(index.num_photos, data["bits"])
+                offset = data["history_offset"]
+            elif index.renumbered is not None and index.renumbered[0] == data["index_token"]:
+                debug("carrying seen photos over to the refreshed index")
+                seen = _renumber(data["bits"], index.renumbered[1], index.num_photos)
+                offset = data["history_offset"]
+                renumbered = True
+            else:
+                debug("seen photos are for an old index: reading the whole history")
+    if seen is None:
+        seen = SeenPhotos(index.num_photos)
+    try:
+        history_size = os.path.getsize(history_path)
+    except OSError:
+        return seen
+    if history_size < offset:
+        # The history's been replaced: start again
+        seen = SeenPhotos(index.num_photos)
+        offset = 0
+    if history_size > offset or renumbered:
+        debug("reading seen photos from %s, from byte %d", history_path, offset)
+        offset = _read_history(index, history_path, offset, seen)
+        _save(path, {
+            "index_token": index.token,
+            "history_path": history_path,
+            "history_offset": offset,
+            "bits": seen.bits,
+        })
+    return seen
+
+
+def _renumber(bits, id_map, num_photos):
+    """ Move the seen photos in a bitmap over old file ids to their new ids """
+    seen = SeenPhotos(num_photos)
+    for byte_id, byte in enumerate(bits):
+        if byte:
+            for bit in range(8):
+                if byte & (1 << bit):
+                    new_id = id_map[(byte_id << 3) | bit]
+                    if new_id >= 0:
+                        seen.add(new_id)
+    return seen
+
+
+def _read_history(index, history_path, offset, seen):
+    """ Add the photos in the history from offset on. Returns the offset read up to """
+    session_prefix = SESSION_PREFIX.encode(ENCODING)
+    with open(history_path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # Still being written: leave it for next time
+                break
+            offset += len(line)
+            if line.startswith(session_prefix) or not line.strip():
+                continue
+            rel_path = line.rstrip(b"\n").decode(ENCODING, "surrogateescape")
+            rel_dir, filename = os.path.split(rel_path)
+            file_id = index.file_id(rel_dir or ".", filename)
+            if file_id is not None:
+                seen.add(file_id)
+    return offset
+
+
+def _save(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def default_seen_path(root_dir):
+    return os.path.join(cache_dir(), "seen", "{}.pickle".format(collection_key(root_dir)))
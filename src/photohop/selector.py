@@ -1,85 +1,181 @@
 import os
 import random
 
+from photohop.index import CollectionIndex, image_filenames
+from photohop.strategies import make_strategy
+from photohop.telemetry import telemetry
+
 
 class PhotoSelector(object):
     """
     Random selection of photos by various methods.
 
-    For now, this just selects randomly from the whole collection.
+    How photos are chosen is up to the strategy, which may be given by
+    name (see photohop.strategies.STRATEGIES). The default, "dirs", chooses
+    a dir at random and then a photo in it. Each photo is only selected once.
 
     """
-    def __init__(self, root_dir, exclude):
+    def __init__(self, root_dir, exclude, index=None, rebuild_index=False, refresh_index=False,
+                 strategy="dirs"):
         self.root_dir = root_dir
         self.exclude = exclude
-        self.exclude_paths = [os.path.join(root_dir, x) for x in exclude]
-
-        self.photo_dir_images = {}
-        self.photo_dirs = []
-
-        for dirname, dirs, filenames in os.walk(self.root_dir):
-            if dirname in self.exclude_paths:
-                dirs.clear()
-                continue
-            # See if there are any image files in this dir
-            image_fns = image_filenames(filenames)
-            if len(image_fns):
-                rel_dir = os.path.relpath(dirname, root_dir)
-                self.photo_dirs.append(rel_dir)
-                self.photo_dir_images[rel_dir] = image_fns
-        if len(self.photo_dirs) == 0:
+
+        # Listing of the collection. Normally loaded from the cache, rather
+        # than walking the whole collection at every launch, and refreshed
+        # by checking for changed dirs if refresh_index=True
+        if index is None:
+            index = CollectionIndex.load(root_dir, exclude, rebuild=rebuild_index, refresh=refresh_index)
+        self.index = index
+        if index.num_photos == 0:
             raise ValueError("no photos found")
 
+        if isinstance(strategy, str):
+            strategy = make_strategy(strategy, index)
+        self.strategy = strategy
+
+        # Photos seen in earlier sessions
+        self.seen = None
+        self.seen_weight = 1.
+
+        # Photos added to the collection since the index was loaded, as
+        # (rel_dir, filename, mtime), and their positions in the list
+        self.added = []
+        self._added_positions = {}
+
+    def set_seen(self, seen, weight=0.):
+        """
+        Make photos that have been seen before (a SeenPhotos) less likely to
+        be selected: weight is how likely, relative to the rest. With
+        weight=0, they're never selected.
+
+        """
+        self.seen = seen
+        self.seen_weight = weight
+
     def get_photo(self):
-        # For now, just choose dirs at random, then choose a random photo
-        if len(self.photo_dirs) == 0:
-            raise ValueError("no more photos left")
-        dir = random.choice(self.photo_dirs)
-        filenames = self.photo_dir_images[dir]
-        # Choose a random photo
-        filename = random.choice(filenames)
-        # Remove this from the directory's image, so it doesn't get selected again
-        self.remove(dir, filename)
-        return SelectedPhoto(dir, filename, self.root_dir)
+        with telemetry.span("get_photo"):
+            # Photos added since the index was loaded are as likely as any other
+            num_added = len(self.added)
+            if num_added and random.randrange(num_added + self.strategy.num_remaining) < num_added:
+                rel_dir, filename, mtime = self.added[random.randrange(num_added)]
+                self._remove_added(rel_dir, filename)
+                return SelectedPhoto(rel_dir, filename, self.root_dir, mtime=mtime)
+            while True:
+                file_id = self.strategy.pick()
+                if self.seen is None or file_id not in self.seen:
+                    break
+                if self.seen_weight == 0.:
+                    # Never show it, so don't let it be picked again
+                    self.remove_id(file_id)
+                elif random.random() < self.seen_weight:
+                    break
+            # Remove this, so it doesn't get selected again
+            self.remove_id(file_id)
+            return SelectedPhoto.from_index(self.index, file_id)
 
     def remove(self, dir, filename):
         """ Remove this dir/filename, so it never gets randomly selected in future """
-        if dir in self.photo_dir_images:
-            if filename in self.photo_dir_images[dir]:
-                self.photo_dir_images[dir].remove(filename)
-            if len(self.photo_dir_images[dir]) == 0:
-                del self.photo_dir_images[dir]
-                self.photo_dirs.remove(dir)
+        file_id = self.index.file_id(dir, filename)
+        if file_id is not None:
+            self.remove_id(file_id)
+        self._remove_added(dir, filename)
+
+    def add(self, dir, filename, mtime=None):
+        """ Add a photo that's appeared in the collection since the index was loaded """
+        key = (dir, filename)
+        if key in self._added_positions:
+            self.added[self._added_positions[key]] = (dir, filename, mtime)
+        else:
+            self._added_positions[key] = len(self.added)
+            self.added.append((dir, filename, mtime))
+
+    def _remove_added(self, dir, filename):
+        pos = self._added_positions.pop((dir, filename), None)
+        if pos is None:
+            return
+        # Move the last one into its place
+        last = self.added.pop()
+        if pos < len(self.added):
+            self.added[pos] = last
+            self._added_positions[last[:2]] = pos
+
+    def remove_id(self, file_id):
+        """ Remove the photo with this id in the index """
+        self.strategy.remove(file_id)
 
 
 class SelectedPhoto(object):
-    def __init__(self, rel_dir, filename, root_dir, display_name=None):
+    """
+    A single photo, as a lightweight view of its entry in the collection,
+    or of a file that isn't in the index (file_id=None).
+
+    """
+    __slots__ = [
+        "rel_dir", "filename", "root_dir", "display_name", "metadata", "file_id",
+        "_abs_path", "_rel_path", "_abs_dir", "_mtime",
+    ]
+
+    def __init__(self, rel_dir, filename, root_dir, display_name=None, file_id=None, mtime=None):
         self.rel_dir = rel_dir
         self.filename = filename
         self.root_dir = root_dir
+        self.file_id = file_id
+        if mtime is not None:
+            self._mtime = mtime
 
         if display_name is None:
-            self.display_name = os.path.join(self.rel_dir, self.filename)
+            self.display_name = self.rel_path
         else:
             self.display_name = display_name
 
-        self.timestamp = None
+        # ImageMetadata, once the image has been loaded
+        self.metadata = None
+
+    @staticmethod
+    def from_index(index, file_id):
+        return SelectedPhoto(
+            index.dir_name(index.file_dirs[file_id]), index.file_name(file_id), index.root_dir,
+            file_id=file_id, mtime=index.file_mtime(file_id)
+        )
+
+    @property
+    def timestamp(self):
+        if self.metadata is None:
+            return None
+        return self.metadata.timestamp
 
     @property
     def abs_path(self):
-        return os.path.join(self.root_dir, self.rel_dir, self.filename)
+        try:
+            return self._abs_path
+        except AttributeError:
+            self._abs_path = os.path.join(self.root_dir, self.rel_dir, self.filename)
+            return self._abs_path
 
     @property
     def rel_path(self):
-        return os.path.join(self.rel_dir, self.filename)
+        try:
+            return self._rel_path
+        except AttributeError:
+            self._rel_path = os.path.join(self.rel_dir, self.filename)
+            return self._rel_path
 
     @property
     def abs_dir(self):
-        return os.path.join(self.root_dir, self.rel_dir)
-
+        try:
+            return self._abs_dir
+        except AttributeError:
+            self._abs_dir = os.path.join(self.root_dir, self.rel_dir)
+            return self._abs_dir
 
-def image_filenames(filenames):
-    return [
-        filename for filename in filenames
-        if filename.lower().rpartition(".")[2] in ["jpg", "png"]
-    ]
+    @property
+    def mtime(self):
+        """ Taken from the index if possible, otherwise from the file. None if it can't be read """
+        try:
+            return self._mtime
+        except AttributeError:
+            try:
+                self._mtime = os.stat(self.abs_path).st_mtime
+            except OSError:
+                self._mtime = None
+            return self._mtime
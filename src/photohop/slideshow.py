@@ -16,6 +16,7 @@ import datetime
 import logging
 import os
 import subprocess
+import threading
 from pathlib import Path
 from collections import OrderedDict
 
@@ -26,17 +27,22 @@ from pyglet_gui.manager import Manager
 from pyglet_gui.gui import Label
 
 
-from PIL import Image, ExifTags  # $ pip install pillow
-from PIL import ImageTk
+from PIL import ImageTk  # $ pip install pillow
 
 from photohop.config import Config
+from photohop.index import CollectionIndex
+from photohop.profiling import Profiler
+from photohop.render import Renderer
+from photohop.telemetry import telemetry
 from photohop.selector import SelectedPhoto, image_filenames, PhotoSelector
 
 debug = logging.debug
 
 
-def random_slideshow(photo_root=None, exclude=[]):
+def random_slideshow(photo_root=None, exclude=[], rebuild_index=False, refresh_index=True):
     config = Config.load()
+    if config["telemetry"]:
+        telemetry.enable(config["telemetry_trace_path"])
 
     # Set up the main window
     window = pyglet.window.Window(fullscreen=True, vsync=True)
@@ -64,14 +70,32 @@ def random_slideshow(photo_root=None, exclude=[]):
         if not photo_root:
             print("No photo root given: exiting")
             return
-    # Index collection in given dir
-    photo_selector = PhotoSelector(photo_root, exclude)
-
-    # Set up a slideshow
-    Slideshow(master, photo_selector, config)
-    master.focus_set()
+    # Index collection in given dir, or load the stored index. Changes
+    # since it was saved are picked up in the background, ready for the
+    # next launch, since refreshing means a stat of every dir
+    photo_selector = PhotoSelector(
+        photo_root, exclude, rebuild_index=rebuild_index, strategy=config["selection_strategy"]
+    )
+    if refresh_index and not rebuild_index:
+        threading.Thread(
+            target=CollectionIndex.load, name="refresh", daemon=True,
+            args=(photo_root, exclude), kwargs={"refresh": True},
+        ).start()
+
+    profiler = Profiler.from_config(config)
+    if profiler is not None:
+        profiler.start()
+    try:
+        # Set up a slideshow
+        Slideshow(master, photo_selector, config)
+        master.focus_set()
 
-    master.mainloop()
+        master.mainloop()
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    if telemetry.enabled:
+        print(telemetry.report())
 
 
 class Slideshow(object):
@@ -155,6 +179,9 @@ class Slideshow(object):
         # the next random leap
         self.queue = []
 
+        # Loads images, ready to show
+        self.renderer = Renderer.from_config(self.config, root_dir=selector.root_dir)
+
         # Set initial size
         self.ma.geometry("800x600")
         # Don't start in fullscreen
@@ -203,29 +230,18 @@ class Slideshow(object):
             # Loading a new image
             self.rotation = 0
             new_image = True
-        path = selected_image.abs_path
-        debug("load %r", path)
-        image = Image.open(path)  # note: let OS manage file cache
-        image = rotate_to_exif(image)
-        selected_image.timestamp = image_datatime(image)
-        if self.rotation > 0:
-            image = image.rotate(self.rotation, expand=True)
-        self.current_image = selected_image
-
-        # shrink image inplace to fit in the application window
+        # shrink image to fit in the application window
         w, h = self.ma.winfo_width(), self.ma.winfo_height()
-        if image.size[0] > w or image.size[1] > h:
-            # note: ImageOps.fit() copies image
-            # preserve aspect ratio
-            if w < 3 or h < 3:  # too small
-                debug("window too small to show image: {}x{}".format(w, h))
-                return  # do nothing
-            image.thumbnail((w - 2, h - 2), Image.ANTIALIAS)
-            debug("resized: win %s >= img %s", (w, h), image.size)
+        image = self.renderer.render(selected_image, (w, h), self.rotation).image
+        self.current_image = selected_image
+        if image is None:
+            debug("window too small to show image: {}x{}".format(w, h))
+            return  # do nothing
 
         # note: pasting into an RGBA image that is displayed might be slow
         # create new image instead
-        self._photo_image = ImageTk.PhotoImage(image)
+        with telemetry.span("photoimage"):
+            self._photo_image = ImageTk.PhotoImage(image)
         self.imglbl.configure(image=self._photo_image)
 
         if new_image:
@@ -374,49 +390,6 @@ def get_image_files(rootdir):
             yield os.path.join(path, filename)
 
 
-for ORIENTATION_TAG in ExifTags.TAGS.keys():
-    if ExifTags.TAGS[ORIENTATION_TAG] == 'Orientation':
-        break
-
-
-def rotate_to_exif(image):
-    if not hasattr(image, "_getexif"):
-        return image
-    exif = image._getexif()
-    if exif is None:
-        return image
-    else:
-        exif = dict(exif.items())
-
-    if ORIENTATION_TAG not in exif:
-        return image
-
-    if exif[ORIENTATION_TAG] == 3:
-        image = image.rotate(180, expand=True)
-    elif exif[ORIENTATION_TAG] == 6:
-        image = image.rotate(270, expand=True)
-    elif exif[ORIENTATION_TAG] == 8:
-        image = image.rotate(90, expand=True)
-    return image
-
-
-def image_datatime(image):
-    try:
-        timestamp_field = image._getexif().get(306, None)
-    except:
-        return None
-    if timestamp_field is None:
-        return None
-    if timestamp_field.startswith("0000"):
-        # Zero timestamp
-        return None
-    timestamp = datetime.datetime.strptime(timestamp_field.partition(" ")[0], "%Y:%m:%d")
-    if timestamp.year == 0:
-        return None
-    else:
-        return timestamp
-
-
 def hide_hidden_files(master):
     """Major incantations to hide hidden files in file browser"""
     try:
@@ -0,0 +1,230 @@
+"""
+Strategies for choosing the next random photo from the collection.
+
+Each strategy divides the photos into groups, chooses a group with
+probability proportional to its weight and then chooses uniformly among
+the photos left in that group. The group weights are held in a
+cumulative-weight table, so a group can be looked up by binary search
+and a weight updated in O(log n) as photos are removed.
+
+"""
+import bisect
+import random
+import time
+from array import array
+
+from photohop.metadata import capture_date_function
+
+
+class GroupedStrategy(object):
+    """
+    Base class for strategies. Subclasses give the groups of file ids and
+    define weight() and group_of().
+
+    """
+    def __init__(self, index, groups):
+        self.index = index
+        self.groups = groups
+        # Until something is removed from a group, all its photos are left.
+        # After that, we keep the ids of those remaining and their positions,
+        # so that they can be removed in constant time
+        self._remaining = {}
+        self._positions = {}
+        self._weights = CumulativeWeights([self.weight(len(group)) for group in groups])
+        # Number of photos left altogether
+        self.num_remaining = sum(len(group) for group in groups)
+
+    def weight(self, size):
+        """ Weight of a group with this many photos left in it """
+        raise NotImplementedError
+
+    def group_of(self, file_id):
+        raise NotImplementedError
+
+    def _init_positions(self, group_id):
+        """
+        Returns an array of positions for the photos of a group, and the
+        base file id that indexes into it
+
+        """
+        return array("i", range(len(self.groups[group_id]))), self.groups[group_id].start
+
+    def pick(self):
+        """ Choose a photo, returning its file id. It's not removed """
+        if self._weights.total == 0:
+            raise ValueError("no more photos left")
+        group_id = self._weights.find(random.randrange(self._weights.total))
+        return random.choice(self._remaining.get(group_id, self.groups[group_id]))
+
+    def remove(self, file_id):
+        group_id = self.group_of(file_id)
+        remaining = self._remaining.get(group_id)
+        if remaining is None:
+            remaining = array("q", self.groups[group_id])
+            self._remaining[group_id] = remaining
+            self._positions[group_id] = self._init_positions(group_id)
+        positions, base = self._positions[group_id]
+        if positions[file_id - base] >= 0:
+            _swap_remove(remaining, positions, file_id, base)
+            self._weights.set(group_id, self.weight(len(remaining)))
+            self.num_remaining -= 1
+
+
+class UniformOverDirs(GroupedStrategy):
+    """
+    Choose a dir at random, then a photo from it. Every dir is equally
+    likely, however many photos it has.
+
+    """
+    def __init__(self, index):
+        super().__init__(index, [index.dir_files(d) for d in range(index.num_dirs)])
+
+    def weight(self, size):
+        return 1 if size else 0
+
+    def group_of(self, file_id):
+        return self.index.file_dirs[file_id]
+
+
+class UniformOverPhotos(UniformOverDirs):
+    """ Every photo is equally likely, so dirs are weighted by their size """
+    def weight(self, size):
+        return size
+
+
+class StratifiedByDate(GroupedStrategy):
+    """
+    Choose a year (or month) at random, then a photo taken in it, so that
+    every period is equally likely, however many photos it has. Photos
+    with no known date form a period of their own.
+
+    dates is a function from file id to a timestamp. By default, capture
+    dates from the metadata store are used, or file mtimes for photos that
+    aren't in it yet.
+
+    """
+    def __init__(self, index, period="year", dates=None):
+        if dates is None:
+            dates = capture_date_function(index)
+        timestamps = [dates(file_id) for file_id in range(index.num_photos)]
+        known = [t for t in timestamps if t is not None]
+        if known:
+            starts = _period_starts(period, min(known), max(known))
+        else:
+            starts = []
+
+        # The period each photo falls in. Undated photos go after the others
+        undated = len(starts)
+        self._file_groups = array("i", (
+            undated if t is None else bisect.bisect_right(starts, t) - 1 for t in timestamps
+        ))
+        groups = [array("q") for _ in range(len(starts) + 1)]
+        # Since every photo is in just one group, their positions can all go
+        # in one array
+        self._file_positions = array("i", [0]) * index.num_photos
+        for file_id, group_id in enumerate(self._file_groups):
+            self._file_positions[file_id] = len(groups[group_id])
+            groups[group_id].append(file_id)
+        super().__init__(index, groups)
+
+    def weight(self, size):
+        return 1 if size else 0
+
+    def group_of(self, file_id):
+        return self._file_groups[file_id]
+
+    def _init_positions(self, group_id):
+        return self._file_positions, 0
+
+
+STRATEGIES = {
+    "dirs": UniformOverDirs,
+    "photos": UniformOverPhotos,
+    "year": lambda index: StratifiedByDate(index, period="year"),
+    "month": lambda index: StratifiedByDate(index, period="month"),
+}
+
+
+def make_strategy(name, index):
+    try:
+        strategy = STRATEGIES[name]
+    except KeyError:
+        raise ValueError("unknown selection strategy '{}'. Choose from: {}".format(
+            name, ", ".join(STRATEGIES)
+        ))
+    return strategy(index)
+
+
+class CumulativeWeights(object):
+    """
+    Integer weights stored as a Fenwick tree, which gives cumulative sums,
+    lookups by cumulative weight and updates of a single weight, all in
+    O(log n).
+
+    """
+    def __init__(self, weights):
+        self.weights = array("q", weights)
+        self.size = len(self.weights)
+        # tree[i] holds the sum of the (i & -i) weights ending at weights[i-1]
+        self.tree = array("q", [0]) + self.weights
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(self.weights)
+        self._top_bit = 1 << (self.size.bit_length() - 1) if self.size else 0
+
+    def set(self, i, weight):
+        delta = weight - self.weights[i]
+        if delta == 0:
+            return
+        self.weights[i] = weight
+        self.total += delta
+        i += 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, value):
+        """
+        Find the index i where the cumulative weight of items before i is
+        <= value and the cumulative weight up to and including i is > value.
+        value should be less than the total.
+
+        """
+        pos = 0
+        step = self._top_bit
+        while step:
+            if pos + step <= self.size and self.tree[pos + step] <= value:
+                pos += step
+                value -= self.tree[pos]
+            step >>= 1
+        return pos
+
+
+def _period_starts(period, first, last):
+    """ Sorted local timestamps of the start of every year or month from first to last """
+    if period not in ("year", "month"):
+        raise ValueError("unknown period '{}'".format(period))
+    first_year = time.localtime(first).tm_year
+    last_year = time.localtime(last).tm_year
+    months = [1] if period == "year" else range(1, 13)
+    return [
+        time.mktime((year, month, 1, 0, 0, 0, 0, 0, -1))
+        for year in range(first_year, last_year + 1) for month in months
+    ]
+
+
+def _swap_remove(items, positions, item, base=0):
+    """
+    Remove item from the array in constant time, by moving the last item
+    into its place. The order of the array isn't preserved. positions gives
+    the position of each item (offset by base) and is updated.
+
+    """
+    pos = positions[item - base]
+    positions[item - base] = -1
+    last = items.pop()
+    if last != item:
+        items[pos] = last
+        positions[last - base] = pos
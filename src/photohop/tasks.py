@@ -0,0 +1,97 @@
+"""
+Running slow side effects, like listing dirs on a network share or
+starting other programs, off the UI thread.
+
+"""
+import logging
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+debug = logging.debug
+
+# How often to check for finished tasks while any are running
+POLL_MS = 50
+
+
+class TaskRunner(object):
+    """
+    Runs functions on a small pool of threads and calls back with their
+    results on the Tk thread, by polling with after(), since Tk can only be
+    used from the thread it runs on.
+
+    on_done is called with the function's result and on_error with the
+    exception it raised, or a TimeoutError if it hasn't finished timeout
+    seconds after it started running (it's left to finish, but its result
+    is ignored). Time spent waiting for a free thread doesn't count. Errors
+    with no on_error are logged and passed to report_error, if given.
+
+    Since there are only a few threads, functions shouldn't wait for
+    anything that could take indefinitely long, like another program
+    exiting.
+
+    """
+    def __init__(self, widget, workers=2, report_error=None):
+        self.widget = widget
+        self.report_error = report_error
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="task")
+        self._results = queue.Queue()
+        # Tasks not yet called back: future -> (description, on_done, on_error,
+        # timeout, started), where started gets the time the task started
+        # running added to it
+        self._pending = {}
+        self._polling = False
+
+    def run(self, description, fn, *args, on_done=None, on_error=None, timeout=None):
+        started = []
+        future = self._pool.submit(_timed, started, fn, *args)
+        self._pending[future] = (description, on_done, on_error, timeout, started)
+        future.add_done_callback(self._results.put)
+        if not self._polling:
+            self._polling = True
+            self.widget.after(POLL_MS, self._poll)
+        return future
+
+    def _poll(self):
+        while True:
+            try:
+                future = self._results.get_nowait()
+            except queue.Empty:
+                break
+            task = self._pending.pop(future, None)
+            if task is None:
+                # Already timed out
+                continue
+            description, on_done, on_error, _, _ = task
+            error = future.exception()
+            if error is not None:
+                self._failed(description, on_error, error)
+            elif on_done is not None:
+                on_done(future.result())
+        now = time.monotonic()
+        for future, (description, _, on_error, timeout, started) in list(self._pending.items()):
+            if timeout is not None and started and now > started[0] + timeout:
+                del self._pending[future]
+                self._failed(description, on_error, TimeoutError("took too long"))
+        if self._pending:
+            self.widget.after(POLL_MS, self._poll)
+        else:
+            self._polling = False
+
+    def _failed(self, description, on_error, error):
+        if on_error is not None:
+            on_error(error)
+            return
+        logging.warning("{} failed: {}".format(description, error))
+        if self.report_error is not None:
+            self.report_error("{} failed: {}".format(description, error))
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pending.clear()
+
+
+def _timed(started, fn, *args):
+    """ Runs on a pool thread: note when the task started, for its timeout """
+    started.append(time.monotonic())
+    return fn(*args)
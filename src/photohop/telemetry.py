@@ -0,0 +1,153 @@
+"""
+Timing the steps of showing a photo, to find out where the time goes
+when a hop is slow.
+
+Code to be timed is wrapped in a span:
+
+    with telemetry.span("open"):
+        image = Image.open(path)
+
+Spans' durations are gathered into a histogram for each name, from
+which percentiles are reported, and can also be written to a trace
+file, one JSON object per line. Telemetry is off until enable() is
+called: until then, span() just returns a do-nothing context manager.
+
+"""
+import json
+import logging
+import math
+import threading
+import time
+
+debug = logging.debug
+
+# Histogram buckets are this much wider than the last, so durations are
+# reported to within about 5%, however long they are
+BUCKET_GROWTH = 1.1
+# Durations shorter than this all go in the first bucket
+MIN_SECONDS = 1e-6
+PERCENTILES = (50, 95, 99)
+
+
+class Telemetry(object):
+    """
+    Collects timing spans, from any thread. See the module docstring.
+
+    """
+    def __init__(self):
+        self.enabled = False
+        self.histograms = {}
+        self._trace = None
+        self._lock = threading.Lock()
+        self._null_span = NullSpan()
+
+    def enable(self, trace_path=None):
+        """ Start collecting spans, also writing them to trace_path, if given """
+        with self._lock:
+            if trace_path is not None and self._trace is None:
+                self._trace = open(trace_path, "a", encoding="utf-8")
+            self.enabled = True
+
+    def disable(self):
+        with self._lock:
+            self.enabled = False
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
+
+    def span(self, name):
+        if not self.enabled:
+            return self._null_span
+        return Span(self, name)
+
+    def record(self, name, start, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+            if self._trace is not None:
+                self._trace.write(json.dumps({
+                    "name": name, "start": start, "ms": round(seconds * 1000, 3),
+                    "thread": threading.current_thread().name,
+                }) + "\n")
+
+    def report(self):
+        """ A table of the count, mean and percentiles of each span's durations, in ms """
+        with self._lock:
+            lines = ["{:12s} {:>7s} {:>9s}".format("span", "count", "mean") +
+                     "".join(" {:>9s}".format("p{}".format(p)) for p in PERCENTILES)]
+            for name, histogram in sorted(self.histograms.items()):
+                lines.append("{:12s} {:7d} {:9.2f}".format(name, histogram.count, histogram.mean() * 1000) +
+                             "".join(" {:9.2f}".format(histogram.percentile(p) * 1000) for p in PERCENTILES))
+            if self._trace is not None:
+                self._trace.flush()
+        return "\n".join(lines)
+
+
+class Span(object):
+    __slots__ = ["telemetry", "name", "start", "_start_counter"]
+
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        self._start_counter = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.telemetry.record(self.name, self.start, time.perf_counter() - self._start_counter)
+
+
+class NullSpan(object):
+    """ Stands in for a Span when telemetry is off """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class Histogram(object):
+    """
+    Counts of durations in exponentially growing buckets, so it takes the
+    same memory however long it runs
+
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.buckets = {}
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        bucket = max(0, math.ceil(math.log(max(seconds, MIN_SECONDS) / MIN_SECONDS, BUCKET_GROWTH)))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def percentile(self, p):
+        """
+        The middle of the bucket the pth percentile falls in, on a log scale,
+        so it's within about 5% of the true value
+
+        """
+        if not self.count:
+            return 0.
+        rank = math.ceil(self.count * p / 100.)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                # Bucket b holds durations above MIN_SECONDS * BUCKET_GROWTH ** (b - 1),
+                # up to MIN_SECONDS * BUCKET_GROWTH ** b
+                return MIN_SECONDS * BUCKET_GROWTH ** max(bucket - 0.5, 0)
+        return self.total
+
+
+# Shared by everything that's timed
+telemetry = Telemetry()
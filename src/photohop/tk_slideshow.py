@@ -15,26 +15,56 @@ directory containing the image, respectively.
 import datetime
 import logging
 import os
+import queue
 import subprocess
+import threading
+import time
 import tkinter as tk
 import tkinter.ttk as ttk
 import ttkthemes
 from pathlib import Path
 from tkinter import filedialog
-from collections import OrderedDict
 
-from PIL import Image, ExifTags  # $ pip install pillow
-from PIL import ImageTk
+from PIL import ImageTk  # $ pip install pillow
 
+from photohop.autoplay import AdvanceSchedule
 from photohop.config import Config
+from photohop.imaging import quick_rescale
+from photohop.index import CollectionIndex
+from photohop.history import ViewingHistory
+from photohop.metadata import MetadataStore, update_metadata
+from photohop.profiling import Profiler, count_instances
+from photohop.render import Renderer
+from photohop.seen import load_seen
 from photohop.selector import SelectedPhoto, image_filenames, PhotoSelector
+from photohop.tasks import TaskRunner
+from photohop.telemetry import telemetry
+from photohop.watch import CollectionWatcher
 
 debug = logging.debug
 
+# How long the window size has to stay the same before the image is
+# properly redrawn for the new size
+RESIZE_SETTLE_MS = 200
+# How often to check whether programs we've started have exited
+PROCESS_POLL_MS = 1000
 
-def random_slideshow(photo_root=None, exclude=[]):
+
+def random_slideshow(photo_root=None, exclude=[], rebuild_index=False, refresh_index=True):
     config = Config.load()
+    if config["telemetry"]:
+        telemetry.enable(config["telemetry_trace_path"])
+    profiler = Profiler.from_config(config)
+    if profiler is not None:
+        profiler.start()
+    try:
+        _run_slideshow(config, photo_root, exclude, rebuild_index, refresh_index, profiler)
+    finally:
+        if profiler is not None:
+            profiler.stop()
 
+
+def _run_slideshow(config, photo_root, exclude, rebuild_index, refresh_index, profiler=None):
     master = tk.Tk()
     master.style = ttkthemes.ThemedStyle()
     master.style.theme_use("equilux")
@@ -49,22 +79,56 @@ def random_slideshow(photo_root=None, exclude=[]):
         if not photo_root:
             print("No photo root given: exiting")
             return
-    # Index collection in given dir
-    photo_selector = PhotoSelector(photo_root, exclude)
+    # Index collection in given dir, or load the stored index. Changes
+    # since it was saved are picked up in the background (refreshing means
+    # a stat of every dir, too slow to wait for on a network share), ready
+    # for the next launch, and the watcher keeps up with them from now on
+    photo_selector = PhotoSelector(
+        photo_root, exclude, rebuild_index=rebuild_index, strategy=config["selection_strategy"]
+    )
+    use_seen = config["seen_weight"] < 1. and config["history_path"] is not None
+    if use_seen:
+        photo_selector.set_seen(load_seen(photo_selector.index, config["history_path"]), config["seen_weight"])
+    if refresh_index and not rebuild_index:
+        threading.Thread(
+            target=_refresh_stored_index, name="refresh", daemon=True,
+            args=(photo_root, exclude, config["history_path"] if use_seen else None),
+        ).start()
 
     # Set up a slideshow
-    Slideshow(master, photo_selector, config)
+    slideshow = Slideshow(master, photo_selector, config)
     master.focus_set()
+    if profiler is not None:
+        # Things that might be taking up more and more memory
+        profiler.counters.update({
+            "history": lambda: len(slideshow.history),
+            "image_cache_bytes": lambda: slideshow.renderer.cache.current_bytes,
+            "photo_images": count_instances(ImageTk.PhotoImage),
+        })
 
     master.mainloop()
 
 
+def _refresh_stored_index(root_dir, exclude, history_path=None):
+    """
+    Bring the stored index up to date, carrying the seen photos over to its
+    new ids. The index the slideshow's using is left as it is
+
+    """
+    index = CollectionIndex.load(root_dir, exclude, refresh=True)
+    if history_path is not None and index.renumbered is not None:
+        load_seen(index, history_path)
+
+
 class Slideshow(object):
     def __init__(self, parent, selector, config):
         self.config = config
         self.selector = selector
         self.ma = parent.winfo_toplevel()
         self._photo_image = None  # must hold reference to PhotoImage
+        # The LoadedImage on screen, for quick redraws while resizing
+        self._shown = None
+        self._resize_job = None
         # How much to rotate the current image by
         self.rotation = 0
 
@@ -103,6 +167,8 @@ class Slideshow(object):
         self.ma.bind("R", self.rotate270)
         self.ma.bind("d", self.queue_current_dir)
         self.ma.bind("<End>", self.random_image)
+        self.ma.bind("p", self.toggle_autoplay)
+        self.ma.bind("t", self.print_timings)
 
         self.ma.bind("<Configure>", self.fit_image)  # fit image on resize
         # Toggle fullscreen with F11
@@ -116,10 +182,12 @@ class Slideshow(object):
         self.context_menu.add_command(label="Next", command=self.next_image, accelerator="Right")
         self.context_menu.add_command(label="View directory", command=self.queue_current_dir, accelerator="d")
         self.context_menu.add_command(label="Next random jump", command=self.random_image, accelerator="End")
+        self.context_menu.add_command(label="Play/pause slideshow", command=self.toggle_autoplay, accelerator="p")
         self.context_menu.add_separator()
         self.context_menu.add_command(label="Rotate right", command=self.rotate90, accelerator="r")
         self.context_menu.add_command(label="Rotate left", command=self.rotate270, accelerator="Shift+r")
         self.context_menu.add_command(label="Toggle fullscreen", command=self.toggle_fullscreen, accelerator="F11")
+        self.context_menu.add_command(label="Print timings", command=self.print_timings, accelerator="t")
 
         def popup(event):
             """ Show popup menu on right click """
@@ -139,18 +207,66 @@ class Slideshow(object):
         # The queue allows you to go through a list of photos before making
         # the next random leap
         self.queue = []
+        # Random photos drawn from the selector ahead of time, so that they
+        # can be prefetched
+        self.upcoming = []
+
+        # Slow things that don't need to hold up the UI are run in the background
+        self.tasks = TaskRunner(self.ma, report_error=self.set_info_text)
+
+        # Metadata of the collection's photos, read in the background, so
+        # photos' EXIF data doesn't need parsing when they're loaded
+        self.metadata_store = MetadataStore.for_collection(selector.root_dir)
+        self._stop_metadata = threading.Event()
+        if self.config["read_metadata"]:
+            threading.Thread(
+                target=update_metadata, name="metadata", daemon=True,
+                args=(selector.index,),
+                kwargs={"workers": self.config["metadata_workers"], "stop": self._stop_metadata},
+            ).start()
+
+        # Images that might be shown next are loaded in the background and
+        # kept in memory, along with those already shown
+        self.renderer = Renderer.from_config(
+            self.config, metadata_store=self.metadata_store, root_dir=selector.root_dir
+        )
+        self.ma.bind("<Destroy>", self._on_destroy)
 
         # Set initial size
         self.ma.geometry("800x600")
         # Don't start in fullscreen
         self.fullscreen_off()
 
+        # Keep up with photos being added and removed while we're running
+        if self.config["watch_collection"] != "off":
+            self.watcher = CollectionWatcher(
+                selector.index, poll=self.config["watch_collection"] == "poll",
+                poll_interval=self.config["watch_poll_seconds"]
+            )
+            self.watcher.start()
+            self.ma.after(1000, self._apply_collection_changes)
+        else:
+            self.watcher = None
+
         # Haven't got this working yet
-        self.viewing_history = ViewingHistory(self.history_path)
+        self.viewing_history = ViewingHistory(
+            self.history_path, flush_interval=self.config["history_flush_seconds"],
+            fsync=self.config["history_fsync"]
+        )
         self.viewing_history.new_session(datetime.datetime.now().strftime("%Y:%m:%d %H:%M:%S"))
 
+        # Advancing automatically to the next photo, every
+        # auto_advance_seconds. None when paused
+        self.schedule = None
+        self._autoplay_job = None
+        # True while autoplay's moving on, rather than the user
+        self._advancing = False
+
         # Start with a random image
         self.ma.after(1, self.next_image)
+        if self.config["auto_advance_seconds"]:
+            # Without saying so, which would hide the first photo's name
+            self.ma.after(1, self._start_autoplay)
 
     @property
     def file_manager_cmd(self):
@@ -174,9 +290,54 @@ class Slideshow(object):
         self.ma.attributes("-fullscreen", True)
         self.fullscreen = True
 
-    def _slideshow(self, filenames, delay_milliseconds):
-        self.show_image(filenames[0])
-        self.imglbl.after(delay_milliseconds, self._slideshow, filenames[1:], delay_milliseconds)
+    def toggle_autoplay(self, event_unused=None):
+        if self.schedule is None:
+            self._start_autoplay()
+            self.set_info_text("Slideshow playing")
+        else:
+            self.ma.after_cancel(self._autoplay_job)
+            debug("slideshow timing: %s", self.schedule.stats())
+            self.schedule = None
+            self.set_info_text("Slideshow paused")
+
+    def _start_autoplay(self):
+        self.schedule = AdvanceSchedule(self.config["auto_advance_seconds"] or 10.)
+        self._schedule_advance()
+
+    def _schedule_advance(self):
+        # The upcoming photos are already being loaded: start switching to
+        # the next a little before it's due, by however long that takes
+        delay = max(self.schedule.time_to_start(), 0.)
+        self._autoplay_job = self.ma.after(int(delay * 1000), self._advance)
+
+    def _advance(self):
+        start = time.monotonic()
+        self._advancing = True
+        try:
+            self.next_image()
+        except ValueError as e:
+            # Run out of photos: nothing more to play
+            logging.warning("slideshow stopped: {}".format(e))
+            debug("slideshow timing: %s", self.schedule.stats())
+            self.schedule = None
+            self.set_info_text("Slideshow stopped: {}".format(e))
+            return
+        except Exception as e:
+            # Don't let one bad photo stop an unattended display
+            logging.exception("could not move on to the next photo")
+            self.set_info_text("Could not show the next photo: {}".format(e))
+        finally:
+            self._advancing = False
+        # Make sure it's actually on screen before we time it
+        self.ma.update_idletasks()
+        self.schedule.advanced(time.monotonic() - start)
+        self._schedule_advance()
+
+    def _restart_autoplay(self):
+        """ Give a photo chosen by hand the full interval, rather than moving on when the last was due to """
+        self.ma.after_cancel(self._autoplay_job)
+        self.schedule.restart()
+        self._schedule_advance()
 
     def show_image(self, selected_image=None):
         if selected_image is None:
@@ -188,33 +349,111 @@ class Slideshow(object):
             # Loading a new image
             self.rotation = 0
             new_image = True
-        path = selected_image.abs_path
-        debug("load %r", path)
-        image = Image.open(path)  # note: let OS manage file cache
-        image = rotate_to_exif(image)
-        selected_image.timestamp = image_datatime(image)
-        if self.rotation > 0:
-            image = image.rotate(self.rotation, expand=True)
-        self.current_image = selected_image
-
-        # shrink image inplace to fit in the application window
+        # shrink image to fit in the application window
         w, h = self.ma.winfo_width(), self.ma.winfo_height()
-        if image.size[0] > w or image.size[1] > h:
-            # note: ImageOps.fit() copies image
-            # preserve aspect ratio
-            if w < 3 or h < 3:  # too small
-                debug("window too small to show image: {}x{}".format(w, h))
-                return  # do nothing
-            image.thumbnail((w - 2, h - 2), Image.ANTIALIAS)
-            debug("resized: win %s >= img %s", (w, h), image.size)
+        try:
+            loaded = self.renderer.render(selected_image, (w, h), self.rotation)
+        except OSError as e:
+            self._load_failed(selected_image, new_image, e)
+            return
+        image = loaded.image
+        self._shown = loaded
+        self.current_image = selected_image
+        if image is None:
+            debug("window too small to show image: {}x{}".format(w, h))
+            return  # do nothing
 
         # note: pasting into an RGBA image that is displayed might be slow
         # create new image instead
-        self._photo_image = ImageTk.PhotoImage(image)
+        with telemetry.span("photoimage"):
+            self._photo_image = ImageTk.PhotoImage(image)
         self.imglbl.configure(image=self._photo_image)
 
         if new_image:
             self._on_new_image(selected_image)
+        self._prefetch_upcoming()
+
+    def _prefetch_upcoming(self):
+        """ Start loading the images that could be shown next """
+        count = self.config["prefetch_count"]
+        if self.history_cursor is not None:
+            # Going through history: we could go either way
+            candidates = self.history[max(self.history_cursor - 1, 0):self.history_cursor + 2]
+        elif len(self.queue):
+            candidates = self.queue[:count]
+        else:
+            # Draw the next random photos now, so we know what they'll be
+            while len(self.upcoming) < count:
+                try:
+                    self.upcoming.append(self.selector.get_photo())
+                except ValueError:
+                    # No more photos left
+                    break
+            candidates = self.upcoming
+        if len(self.history) > 1 and self.history_cursor is None:
+            # Going back one is always an option
+            candidates = candidates + self.history[-2:-1]
+
+        size = (self.ma.winfo_width(), self.ma.winfo_height())
+        for photo in candidates:
+            self.renderer.prefetch(photo, size)
+
+    def _load_failed(self, selected_image, new_image, error):
+        """ The file's been deleted, or can't be read: move on to another """
+        logging.warning("could not load {}: {}".format(selected_image.abs_path, error))
+        self.selector.remove(selected_image.rel_dir, selected_image.filename)
+        if new_image and self.history_cursor is None and len(self.history) and self.history[-1] is selected_image:
+            # Just chosen: choose another instead
+            self.history.pop()
+            self.ma.after(1, self.next_image)
+        else:
+            self.set_info_text("Could not load {}".format(selected_image.display_name))
+
+    def _apply_collection_changes(self):
+        """ Update the selector with the changes the watcher has found. Runs on the UI thread """
+        removed = set()
+        while True:
+            try:
+                change = self.watcher.changes.get_nowait()
+            except queue.Empty:
+                break
+            if change[0] == "add":
+                _, rel_dir, filename, mtime = change
+                self.selector.add(rel_dir, filename, mtime)
+                removed.discard((rel_dir, filename))
+            else:
+                _, rel_dir, filename = change
+                self.selector.remove(rel_dir, filename)
+                removed.add((rel_dir, filename))
+        if removed:
+            debug("%d photos removed from collection", len(removed))
+            # Don't go on to photos that aren't there any more
+            self.upcoming = [p for p in self.upcoming if (p.rel_dir, p.filename) not in removed]
+            self.queue = [p for p in self.queue if (p.rel_dir, p.filename) not in removed]
+        self.ma.after(1000, self._apply_collection_changes)
+
+    def _on_destroy(self, event):
+        if event.widget is self.ma:
+            self._stop_metadata.set()
+            if self.schedule is not None:
+                debug("slideshow timing: %s", self.schedule.stats())
+            if self.watcher is not None:
+                self.watcher.stop()
+            self.viewing_history.close()
+            self.renderer.shutdown()
+            self.tasks.shutdown()
+            debug("rendering: %s", self.renderer.stats())
+            if telemetry.enabled:
+                print(telemetry.report())
+                telemetry.disable()
+
+    def print_timings(self, event_unused=None):
+        """ Print how long each step of showing photos has taken so far """
+        if telemetry.enabled:
+            print(telemetry.report())
+            self.set_info_text("Timings printed")
+        else:
+            self.set_info_text("Timing is off: set telemetry in the config to turn it on")
 
     def _on_new_image(self, selected_image):
         if selected_image.timestamp is not None:
@@ -222,6 +461,8 @@ class Slideshow(object):
         else:
             self.info_var.set(selected_image.display_name)
         self.viewing_history.add_entry(selected_image.rel_path)
+        if self.schedule is not None and not self._advancing:
+            self._restart_autoplay()
 
     def set_info_text(self, text):
         self.info_var.set(text)
@@ -230,7 +471,11 @@ class Slideshow(object):
         self.show_image()
 
     def random_image(self, event_unused=None):
-        selected = self.selector.get_photo()
+        if len(self.upcoming):
+            # Already chosen, and hopefully loaded
+            selected = self.upcoming.pop(0)
+        else:
+            selected = self.selector.get_photo()
         # Add new image to end of history
         self.history.append(selected)
         self.history_cursor = None
@@ -284,71 +529,76 @@ class Slideshow(object):
         and start on the first image
         """
         current = self.current_image
-        current_dir = current.abs_dir
-        filenames = image_filenames(os.listdir(current_dir))
-        if len(filenames):
-            self.queue = [
-                SelectedPhoto(
-                    current.rel_dir, fn, current.root_dir,
-                    display_name="{} [{}/{}] ({})".format(current.rel_dir, i, len(filenames), fn)
-                ) for i, fn in enumerate(filenames, start=1)
-            ]
-            self.next_image()
+
+        def queue_files(filenames):
+            if self.current_image is not current or self.history_cursor is not None:
+                # Moved on while it was being listed
+                debug("dropping listing of %s", current.rel_dir)
+                return
+            if len(filenames):
+                self.queue = [
+                    SelectedPhoto(
+                        current.rel_dir, fn, current.root_dir,
+                        display_name="{} [{}/{}] ({})".format(current.rel_dir, i, len(filenames), fn)
+                    ) for i, fn in enumerate(filenames, start=1)
+                ]
+                self.next_image()
+
+        # Listing may be slow on a network share
+        self.tasks.run(
+            "Listing {}".format(current.rel_dir), lambda: image_filenames(os.listdir(current.abs_dir)),
+            on_done=queue_files, timeout=30
+        )
 
     def open_file_manager(self, event_unused=None):
         if self.file_manager_cmd is not None:
             cmd_subst = dict(image=self.current_image.abs_path, image_dir=self.current_image.abs_dir)
             cmd_parts = self.file_manager_cmd.split()
             cmd_parts = [part.format(**cmd_subst) for part in cmd_parts]
-            subprocess.call(cmd_parts)
+            try:
+                process = subprocess.Popen(cmd_parts)
+            except OSError as e:
+                logging.warning("Opening file manager failed: {}".format(e))
+                self.set_info_text("Opening file manager failed: {}".format(e))
+                return
+            # It may stay open for a long time: just check now and then
+            # whether it's exited, to report errors
+            self.ma.after(PROCESS_POLL_MS, self._check_process, process)
+
+    def _check_process(self, process):
+        returncode = process.poll()
+        if returncode is None:
+            self.ma.after(PROCESS_POLL_MS, self._check_process, process)
+        elif returncode != 0:
+            message = "{} exited with status {}".format(process.args[0], returncode)
+            logging.warning(message)
+            self.set_info_text(message)
 
     def fit_image(self, event=None, _last=[None] * 2):
-        """Fit image inside application window on resize."""
+        """
+        Fit image inside application window on resize.
+
+        While the size is changing, the image on screen is just stretched
+        to fit, which needs no loading. It's only redrawn properly once the
+        size has settled.
+
+        """
         if event is not None and event.widget is self.ma and (
                 _last[0] != event.width or _last[1] != event.height):
             # size changed; update image
             _last[:] = event.width, event.height
-            self.show_image()
-
-
-class ViewingHistory(object):
-    """
-    Path may be set to None, meaning no output is written.
-
-    """
-    def __init__(self, path):
-        self.path = path
-        self.sessions = OrderedDict()
-        # If the file exists, load previous viewing history
-        if path is not None and os.path.exists(path):
-            self.load_history()
-
-    def _append_line(self, line):
-        if self.path is not None:
-            with open(self.path, "a") as f:
-                f.write(line)
-
-    def new_session(self, name):
-        self.sessions[name] = []
-        self._append_line("SESSION: {}\n".format(name))
-
-    def add_entry(self, filename):
-        self.current_session.append(filename)
-        self._append_line("{}\n".format(filename))
-
-    def load_history(self):
-        with open(self.path, "r") as f:
-            for line in f:
-                line = line.rstrip("\n")
-                if line.startswith("SESSION: "):
-                    session_name = line[9:]
-                    self.sessions[session_name] = []
-                elif len(line.strip()):
-                    self.current_session.append(line)
-
-    @property
-    def current_session(self):
-        return self.sessions[next(reversed(self.sessions))]
+            if self._shown is not None:
+                image = quick_rescale(self._shown, (event.width, event.height))
+                if image is not None:
+                    self._photo_image = ImageTk.PhotoImage(image)
+                    self.imglbl.configure(image=self._photo_image)
+            if self._resize_job is not None:
+                self.ma.after_cancel(self._resize_job)
+            self._resize_job = self.ma.after(RESIZE_SETTLE_MS, self._resize_settled)
+
+    def _resize_settled(self):
+        self._resize_job = None
+        self.show_image()
 
 
 def get_image_files(rootdir):
@@ -359,49 +609,6 @@ def get_image_files(rootdir):
             yield os.path.join(path, filename)
 
 
-for ORIENTATION_TAG in ExifTags.TAGS.keys():
-    if ExifTags.TAGS[ORIENTATION_TAG] == 'Orientation':
-        break
-
-
-def rotate_to_exif(image):
-    if not hasattr(image, "_getexif"):
-        return image
-    exif = image._getexif()
-    if exif is None:
-        return image
-    else:
-        exif = dict(exif.items())
-
-    if ORIENTATION_TAG not in exif:
-        return image
-
-    if exif[ORIENTATION_TAG] == 3:
-        image = image.rotate(180, expand=True)
-    elif exif[ORIENTATION_TAG] == 6:
-        image = image.rotate(270, expand=True)
-    elif exif[ORIENTATION_TAG] == 8:
-        image = image.rotate(90, expand=True)
-    return image
-
-
-def image_datatime(image):
-    try:
-        timestamp_field = image._getexif().get(306, None)
-    except:
-        return None
-    if timestamp_field is None:
-        return None
-    if timestamp_field.startswith("0000"):
-        # Zero timestamp
-        return None
-    timestamp = datetime.datetime.strptime(timestamp_field.partition(" ")[0], "%Y:%m:%d")
-    if timestamp.year == 0:
-        return None
-    else:
-        return timestamp
-
-
 def hide_hidden_files(master):
     """Major incantations to hide hidden files in file browser"""
     try:
@@ -0,0 +1,341 @@
+"""
+Watching the collection for photos being added, removed or changed while
+a slideshow is running.
+
+On Linux, inotify says which dirs have changed as soon as they do.
+Elsewhere, or where there are too many dirs to watch, or on network
+shares, where inotify doesn't hear about changes made by other machines,
+the dirs' mtimes are checked every so often instead. Either way, a
+changed dir is listed again and compared with what was there before.
+
+Network shares are recognised by their filesystem type, in /proc/mounts.
+
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import queue
+import re
+import select
+import struct
+import sys
+import threading
+
+from photohop.index import list_dir, _rel_join
+
+debug = logging.debug
+
+# Wait this long after a change before listing the dir, so a batch of
+# photos being copied in is picked up in one go
+SETTLE_SECONDS = 1.
+
+# Filesystem types where inotify only hears about changes made locally
+NETWORK_FILESYSTEMS = frozenset([
+    "nfs", "nfs4", "cifs", "smbfs", "smb3", "afs", "9p", "ceph", "glusterfs", "lustre",
+    "fuse.sshfs", "fuse.rclone", "fuse.glusterfs", "fuse.cephfs",
+])
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_ONLYDIR = 0x1000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class CollectionWatcher(object):
+    """
+    Watches the dirs in a CollectionIndex on a background thread and puts
+    changes to the photos in them on the changes queue, as
+    ("add", rel_dir, filename, mtime) or ("remove", rel_dir, filename).
+    A photo that's changed is removed and added again, and a rename is a
+    remove and an add.
+
+    The queue is for the UI thread to take changes from, so nothing else
+    needs to be shared between threads.
+
+    If the collection is on a network share, it's polled even if poll is
+    False, since inotify wouldn't hear about changes made elsewhere.
+
+    """
+    def __init__(self, index, poll=False, poll_interval=300.):
+        self.index = index
+        self.root_dir = index.root_dir
+        self.poll = poll
+        self.poll_interval = poll_interval
+        self.changes = queue.Queue()
+        self._exclude = set(os.path.normpath(x) for x in index.exclude)
+        # Photos in dirs that have changed since the index was made,
+        # filename -> mtime for each dir
+        self._files = {}
+        # mtimes of dirs that have changed
+        self._dir_mtimes = {}
+        # Dirs that have appeared since the index was made, and index dirs
+        # that have gone
+        self._new_dirs = set()
+        self._gone = set()
+        # Subdir names of each dir, only worked out when first needed
+        self._subdirs = None
+        self._inotify = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not self.poll:
+            fs_type = filesystem_type(self.root_dir)
+            if fs_type in NETWORK_FILESYSTEMS:
+                logging.warning(
+                    "collection is on a network share ({}), where changes made elsewhere can't be watched: "
+                    "checking it every {}s instead".format(fs_type, self.poll_interval)
+                )
+                self.poll = True
+        # Watching every dir can take a while on a big collection, so it's
+        # started on the watcher thread too
+        self._thread = threading.Thread(target=self._watch, name="watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _abs(self, rel_dir):
+        return os.path.join(self.root_dir, rel_dir)
+
+    def _watch(self):
+        if not self.poll:
+            try:
+                self._inotify = Inotify()
+                for dir_id in range(self.index.num_dirs):
+                    rel_dir = self.index.dir_name(dir_id)
+                    if self._stop.is_set():
+                        break
+                    self._inotify.add_watch(rel_dir, self._abs(rel_dir))
+            except OSError as e:
+                logging.info("can't watch collection with inotify ({}): checking it every {}s instead".format(
+                    e, self.poll_interval
+                ))
+                if self._inotify is not None:
+                    self._inotify.close()
+                    self._inotify = None
+        if self._inotify is not None:
+            self._watch_inotify()
+        else:
+            self._watch_polling()
+
+    def _watch_polling(self):
+        while not self._stop.wait(self.poll_interval):
+            self._check_all()
+
+    def _watch_inotify(self):
+        try:
+            while not self._stop.is_set():
+                changed = self._inotify.read(timeout=1.)
+                if not changed:
+                    continue
+                # Let things settle, and gather any other changes
+                self._stop.wait(SETTLE_SECONDS)
+                changed |= self._inotify.read(timeout=0)
+                if None in changed:
+                    # Events were lost
+                    self._check_all()
+                else:
+                    for rel_dir in sorted(changed):
+                        if not self._stop.is_set():
+                            self._dir_changed(rel_dir)
+        finally:
+            self._inotify.close()
+
+    def _known_dirs(self):
+        for dir_id in range(self.index.num_dirs):
+            rel_dir = self.index.dir_name(dir_id)
+            if rel_dir not in self._gone:
+                yield rel_dir, self.index.dir_mtimes[dir_id]
+        for rel_dir in list(self._new_dirs):
+            yield rel_dir, None
+
+    def _check_all(self):
+        """ Check the mtimes of every dir, listing those that have changed """
+        for rel_dir, index_mtime in self._known_dirs():
+            if self._stop.is_set():
+                return
+            if rel_dir in self._gone:
+                # Its parent has already found it gone
+                continue
+            try:
+                mtime = os.stat(self._abs(rel_dir)).st_mtime
+            except OSError:
+                self._dir_removed(rel_dir)
+                continue
+            if mtime != self._dir_mtimes.get(rel_dir, index_mtime):
+                self._dir_changed(rel_dir)
+
+    def _known_files(self, rel_dir):
+        files = self._files.get(rel_dir)
+        if files is not None:
+            return files
+        dir_id = self.index.dir_ids.get(rel_dir)
+        if dir_id is None:
+            return {}
+        return dict(
+            (self.index.file_name(f), self.index.file_mtime(f)) for f in self.index.dir_files(dir_id)
+        )
+
+    def _known_subdirs(self, rel_dir):
+        if self._subdirs is None:
+            self._subdirs = {}
+            for dir_id, names in enumerate(self.index._subdir_names()):
+                self._subdirs[self.index.dir_name(dir_id)] = set(names)
+        return self._subdirs.setdefault(rel_dir, set())
+
+    def _dir_changed(self, rel_dir):
+        """ List a dir again and report the differences """
+        try:
+            mtime = os.stat(self._abs(rel_dir)).st_mtime
+            record = list_dir(self._abs(rel_dir), mtime)
+        except OSError:
+            self._dir_removed(rel_dir)
+            return
+        old_files = self._known_files(rel_dir)
+        new_files = dict(zip(record.filenames, record.file_mtimes))
+        for filename, file_mtime in old_files.items():
+            if new_files.get(filename, -1) != file_mtime:
+                self.changes.put(("remove", rel_dir, filename))
+        for filename, file_mtime in new_files.items():
+            if old_files.get(filename, -1) != file_mtime:
+                self.changes.put(("add", rel_dir, filename, file_mtime))
+        self._files[rel_dir] = new_files
+        self._dir_mtimes[rel_dir] = mtime
+
+        subdirs = set(d for d in record.subdirs if _rel_join(rel_dir, d) not in self._exclude)
+        old_subdirs = self._known_subdirs(rel_dir)
+        for name in old_subdirs - subdirs:
+            self._dir_removed(_rel_join(rel_dir, name))
+        for name in subdirs - old_subdirs:
+            self._dir_added(_rel_join(rel_dir, name))
+        old_subdirs.clear()
+        old_subdirs.update(subdirs)
+
+    def _dir_added(self, rel_dir):
+        debug("new dir %s", rel_dir)
+        self._gone.discard(rel_dir)
+        if self.index.dir_ids.get(rel_dir) is None:
+            self._new_dirs.add(rel_dir)
+        # All its contents are new
+        self._files[rel_dir] = {}
+        self._known_subdirs(rel_dir).clear()
+        if self._inotify is not None:
+            try:
+                self._inotify.add_watch(rel_dir, self._abs(rel_dir))
+            except OSError as e:
+                logging.warning("can't watch {}: {}".format(rel_dir, e))
+        self._dir_changed(rel_dir)
+
+    def _dir_removed(self, rel_dir):
+        debug("dir gone %s", rel_dir)
+        for filename in self._known_files(rel_dir):
+            self.changes.put(("remove", rel_dir, filename))
+        self._files[rel_dir] = {}
+        self._new_dirs.discard(rel_dir)
+        if self.index.dir_ids.get(rel_dir) is not None:
+            self._gone.add(rel_dir)
+        subdirs = self._known_subdirs(rel_dir)
+        for name in list(subdirs):
+            self._dir_removed(_rel_join(rel_dir, name))
+        subdirs.clear()
+
+
+class Inotify(object):
+    """ Just enough of Linux's inotify, through ctypes, to tell which dirs have changed """
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise _errno_error()
+        # Watch descriptor -> rel_dir
+        self._dirs = {}
+
+    def add_watch(self, rel_dir, abs_dir):
+        wd = self._add_watch(self.fd, os.fsencode(abs_dir), WATCH_MASK)
+        if wd < 0:
+            error = _errno_error()
+            if error.errno in (errno.ENOENT, errno.ENOTDIR):
+                # Gone already: its parent will notice
+                return
+            raise error
+        self._dirs[wd] = rel_dir
+
+    def read(self, timeout):
+        """
+        The set of dirs that have had changes, waiting up to timeout seconds
+        for any. Contains None if events were lost.
+
+        """
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+                pos += INOTIFY_EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    changed.add(None)
+                    continue
+                rel_dir = self._dirs.get(wd)
+                if rel_dir is None:
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    # Reported to the parent dir too
+                    continue
+                changed.add(rel_dir)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def filesystem_type(path):
+    """
+    The type of the filesystem path is on, from /proc/mounts, or None if it
+    can't be found out (on anything but Linux)
+
+    """
+    try:
+        with open("/proc/mounts", "rb") as f:
+            mounts = f.read().decode("utf-8", "surrogateescape").splitlines()
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    best, best_type = None, None
+    for line in mounts:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        # Spaces and the like are escaped as octal
+        mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[1])
+        if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and \
+                (best is None or len(mount_point) >= len(best)):
+            best, best_type = mount_point, fields[2]
+    return best_type
+
+
+def _errno_error():
+    e = ctypes.get_errno()
+    return OSError(e, os.strerror(e))